@@ -154,7 +154,8 @@ class BamMetrics(val root: Configurable) extends QScript with SummaryQScript wit
       val coverageFile = new File(targetDir, inputBam.getName.stripSuffix(".bam") + ".coverage")
 
       //FIXME:should use piping
-      add(BedtoolsCoverage(this, inputBam, intervals.bed, coverageFile, depth = true), true)
+      // a per-feature histogram gives the same coverage stats as per-base output, at a fraction of the size
+      add(BedtoolsCoverage(this, inputBam, intervals.bed, coverageFile, depth = false, histogram = true), true)
       val covStats = CoverageStats(this, coverageFile, targetDir)
       add(covStats)
       addSummarizable(covStats, "cov_stats")
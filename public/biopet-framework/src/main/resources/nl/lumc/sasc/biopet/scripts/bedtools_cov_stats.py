@@ -19,6 +19,32 @@
 """
 Plot output of coverageBed / "bedtools coverage" when run with the -d flag.
 
+Run-length coverage is also accepted, either as bedGraph ("bedtools genomecov
+-bga") or as coverageBed -hist output. Intervals and histogram bins are
+weighted by their number of bases, giving the same statistics as the
+equivalent per-base output. Alternatively, an indexed BAM file and a BED file
+of target regions can be given, in which case the per-base depth is computed
+directly from the alignments (requires pysam).
+
+The coverage histograms can be saved (--histograms-out) and later summed with
+the merge command, e.g. to combine results of inputs that were scattered per
+chromosome without reading the per-base coverage again:
+
+    bedtools_cov_stats.py merge chr1.hist.json chr2.hist.json --plot out.png
+
+Merging is only valid for inputs covering disjoint positions. The depth of a
+base covered by multiple inputs (e.g. per lane) is the sum of their depths,
+which can not be computed from their histograms, so the same chromosome in
+multiple inputs is rejected. The same region name in multiple inputs gives a
+warning, as it is only valid for regions with intervals on multiple
+chromosomes.
+
+Per-base coverage can also be cached (--cache) as memory-mapped arrays, so
+runs with different plot settings do not parse the input again.
+
+For assemblies with many contigs, the per-contig statistics can be written as
+a TSV or NDJSON table (--contig-stats) instead of the JSON output.
+
 
 This script plots a bar graph showing how many times a base covered X times
 are found. An additional box plot is also plotted to show the general trend
@@ -31,7 +57,7 @@ still computed from the complete data set (0x coverage included).
 
 Requirements:
     * Python == 2.7.x
-    * Matplotlib >= 1.3.0
+    * Matplotlib >= 1.4.0
     * Numpy >= 1.8.0
 
 Copyright (c) 2013 Wibowo Arindrarto <w.arindrarto@lumc.nl>
@@ -46,12 +72,20 @@ __version__ += '-dev' if not RELEASE else ''
 
 
 import argparse
+import bisect
 import collections
+import io
 import itertools
 import json
 import locale
+import math
+import multiprocessing
 import os
+import shutil
 import sys
+import tempfile
+import warnings
+import zlib
 
 import matplotlib
 matplotlib.use('Agg')
@@ -60,6 +94,11 @@ import matplotlib.pyplot as plt
 import matplotlib.ticker as tkr
 import numpy as np
 
+try:
+    import pysam
+except ImportError:
+    pysam = None
+
 
 BLUE = '#2166AC'
 RED = '#1A9850'
@@ -69,6 +108,33 @@ locale.setlocale(locale.LC_ALL, '')
 group_digits = lambda x, pos: locale.format('%d', x, grouping=True)
 major_formatter = tkr.FuncFormatter(group_digits)
 
+# number of bytes of coverageBed output parsed at a time
+CHUNK_SIZE = 16 * 1024 * 1024
+_TAB, _NEWLINE, _ZERO = ord('\t'), ord('\n'), ord('0')
+# prefixes of bedGraph lines that do not contain coverage
+HEADER_PREFIXES = (b'#', b'track', b'browser')
+_HEADER_CHARS = [ord(prefix[0]) for prefix in HEADER_PREFIXES]
+# maximum number of digits parsed per integer
+_MAX_INT_WIDTH = 18
+# number of target bases of which the depth is computed at a time from BAM
+BAM_BLOCK_SIZE = 1000000
+# default coverage thresholds of the quick statistics
+THRESHOLDS = (10, 20, 30, 40, 50)
+# first bytes of gzip-compressed (including BGZF) files
+GZIP_MAGIC = b'\x1f\x8b'
+# first bytes of the decompressed content of BAM files
+BAM_MAGIC = b'BAM\x01'
+# default size of the windows of the windowed mean coverage output
+WINDOW_SIZE = 100000
+# number of cached bases of which the coverage is read at a time
+CACHE_BLOCK_SIZE = 1 << 22
+# identifier and version of the coverage cache index
+CACHE_FORMAT = 'bedtools_cov_stats-cache'
+CACHE_VERSION = 1
+# identifier and version of saved histogram files
+HISTOGRAM_FORMAT = 'bedtools_cov_stats-histograms'
+HISTOGRAM_VERSION = 1
+
 
 def cachedproperty(func):
     """Decorator for cached property loading."""
@@ -85,6 +151,1405 @@ def cachedproperty(func):
     return cached
 
 
+def iter_chunks(instream, chunk_size=CHUNK_SIZE, size=None):
+    """Yields chunks of complete lines read from the given stream.
+
+    :param instream: input handle
+    :type instream: file
+    :param chunk_size: number of bytes to read at a time
+    :type chunk_size: int
+    :param size: number of bytes to read in total, or None to read until the
+        end of the stream
+    :type size: int
+
+    """
+    rest = b''
+    while True:
+        if size is None:
+            data = instream.read(chunk_size)
+        else:
+            data = instream.read(min(chunk_size, size))
+            size -= len(data)
+        if not data:
+            break
+        data = rest + data
+        # only pass on complete lines, the rest is kept for the next chunk
+        end = data.rfind(b'\n') + 1
+        rest = data[end:]
+        if end:
+            yield data[:end]
+    if rest.strip():
+        yield rest + b'\n'
+
+
+def parse_int_field(buf, ends):
+    """Parses the unsigned integer fields that end at the given offsets.
+
+    The fields are parsed from right to left, one digit position of all
+    fields at a time, until a tab is found in front of every field.
+
+    :param buf: bytes to parse
+    :type buf: numpy.ndarray of numpy.uint8
+    :param ends: end offset (exclusive) of each field
+    :type ends: numpy.ndarray
+    :returns: parsed integers and the offset of the tab in front of each
+        field
+    :rtype: tuple of (numpy.ndarray, numpy.ndarray)
+
+    """
+    values = np.zeros(len(ends), dtype=np.int64)
+    tabs = np.empty_like(ends)
+    active = np.ones(len(ends), dtype=bool)
+    offsets = ends
+    for width in range(_MAX_INT_WIDTH + 1):
+        offsets = offsets - 1
+        chars = buf.take(offsets, mode='clip')
+        at_tab = chars == _TAB
+        at_tab &= active
+        tabs[at_tab] = offsets[at_tab]
+        active ^= at_tab
+        if not active.any():
+            break
+        # characters below '0' wrap around to values above 9
+        digits = chars - _ZERO
+        if width == _MAX_INT_WIDTH or (digits[active] > 9).any():
+            raise ValueError("Invalid integer value in input")
+        digits[~active] = 0
+        values += digits.astype(np.int64) * 10 ** width
+    if (tabs == ends - 1).any():
+        raise ValueError("Empty integer value in input")
+
+    return values, tabs
+
+
+def parse_next_int_field(buf, tabs):
+    """Parses the unsigned integer fields that follow the given tabs.
+
+    The fields are parsed from left to right, one digit position of all
+    fields at a time, until a tab or newline is found after every field.
+
+    :param buf: bytes to parse
+    :type buf: numpy.ndarray of numpy.uint8
+    :param tabs: offset of the tab in front of each field
+    :type tabs: numpy.ndarray
+    :returns: parsed integers and the offset of the tab or newline after
+        each field
+    :rtype: tuple of (numpy.ndarray, numpy.ndarray)
+
+    """
+    values = np.zeros(len(tabs), dtype=np.int64)
+    ends = np.empty_like(tabs)
+    active = np.ones(len(tabs), dtype=bool)
+    offsets = tabs
+    for width in range(_MAX_INT_WIDTH + 1):
+        offsets = offsets + 1
+        chars = buf.take(offsets, mode='clip')
+        at_end = (chars == _TAB) | (chars == _NEWLINE)
+        at_end &= active
+        ends[at_end] = offsets[at_end]
+        active ^= at_end
+        if not active.any():
+            break
+        # characters below '0' wrap around to values above 9
+        digits = chars - _ZERO
+        if width == _MAX_INT_WIDTH or (digits[active] > 9).any():
+            raise ValueError("Invalid integer value in input")
+        values[active] = values[active] * 10 + digits[active]
+    if (ends == tabs + 1).any():
+        raise ValueError("Empty integer value in input")
+
+    return values, ends
+
+
+def find_name_runs(buf, starts):
+    """Finds runs of consecutive lines with the same first column.
+
+    The first column of all lines is compared with that of the previous
+    line, one byte position at a time, until a tab is found in every line.
+
+    :param buf: bytes to parse
+    :type buf: numpy.ndarray of numpy.uint8
+    :param starts: start offset of each line
+    :type starts: numpy.ndarray
+    :returns: index of the first line of each run and the offset of the tab
+        after the first column of each line
+    :rtype: tuple of (numpy.ndarray, numpy.ndarray)
+
+    """
+    changed = np.zeros(len(starts) - 1, dtype=bool)
+    tabs = np.full_like(starts, -1)
+    ended = np.zeros(len(starts), dtype=bool)
+    offsets = starts
+    while not ended.all():
+        chars = buf.take(offsets, mode='clip')
+        # names are only compared while at least one of them is not done
+        changed |= (chars[1:] != chars[:-1]) & ~(ended[1:] & ended[:-1])
+        at_tab = chars == _TAB
+        at_tab &= ~ended
+        tabs[at_tab] = offsets[at_tab]
+        ended |= at_tab
+        ended |= chars == _NEWLINE
+        offsets = offsets + 1
+    if (tabs == -1).any():
+        raise ValueError("Missing columns in input")
+
+    return np.concatenate(([0], np.flatnonzero(changed) + 1)), tabs
+
+
+def find_lines(chunk, skip_headers=False):
+    """Finds the nonempty lines in a chunk of complete lines.
+
+    :param chunk: complete lines
+    :type chunk: str
+    :param skip_headers: whether to also skip comment, track and browser lines
+    :type skip_headers: bool
+    :returns: chunk bytes, and the start and end (exclusive, at the newline)
+        offsets of each line
+    :rtype: tuple of (numpy.ndarray, numpy.ndarray, numpy.ndarray)
+
+    """
+    buf = np.frombuffer(chunk, dtype=np.uint8)
+    line_ends = np.flatnonzero(buf == _NEWLINE)
+    line_starts = np.empty_like(line_ends)
+    line_starts[0] = 0
+    line_starts[1:] = line_ends[:-1] + 1
+    skip = line_ends == line_starts
+    if skip_headers:
+        first_chars = buf.take(line_starts, mode='clip')
+        for idx in np.flatnonzero(np.in1d(first_chars, _HEADER_CHARS)):
+            skip[idx] = chunk.startswith(HEADER_PREFIXES, line_starts[idx])
+    if skip.any():
+        line_starts, line_ends = line_starts[~skip], line_ends[~skip]
+
+    return buf, line_starts, line_ends
+
+
+# Parsed chunk of coverage output:
+# names: chromosome name of each run of lines with the same chromosome
+# run_starts: index of the first line of each run
+# values: coverage of each line
+# weights: number of positions of each line, or None if each line is a
+#          single position
+# positions: 0-based genomic position of each line, or None if not parsed
+ParsedChunk = collections.namedtuple('ParsedChunk',
+        ['names', 'run_starts', 'values', 'weights', 'positions'])
+
+
+def iter_runs(parsed):
+    """Yields the chromosome name and the start and end (exclusive) line
+    index of each run of lines of a parsed chunk."""
+    run_ends = np.append(parsed.run_starts[1:], len(parsed.values))
+    return zip(parsed.names, parsed.run_starts, run_ends)
+
+
+def parse_depth_chunk(chunk, positions=False):
+    """Parses a chunk of complete lines of coverageBed -d output.
+
+    :param chunk: complete lines of coverageBed -d output
+    :type chunk: str
+    :param positions: whether to parse the genomic position of each line
+    :type positions: bool
+    :rtype: ParsedChunk
+
+    """
+    buf, line_starts, line_ends = find_lines(chunk)
+    if not len(line_ends):
+        return ParsedChunk([], line_ends, line_ends, None,
+                line_ends if positions else None)
+
+    # coverage is the last column and chromosome the first column
+    values, tabs = parse_int_field(buf, line_ends)
+    run_starts, first_tabs = find_name_runs(buf, line_starts)
+    run_names = [chunk[line_starts[i]:first_tabs[i]] for i in run_starts]
+    # position is the feature start (second column) plus the 1-based offset
+    # in the feature (second last column)
+    pos = None
+    if positions:
+        offsets, _ = parse_int_field(buf, tabs)
+        feature_starts, _ = parse_next_int_field(buf, first_tabs)
+        pos = feature_starts + offsets - 1
+
+    return ParsedChunk(run_names, run_starts, values, None, pos)
+
+
+def parse_bedgraph_chunk(chunk, positions=False):
+    """Parses a chunk of complete lines of bedGraph output, as written by
+    ``bedtools genomecov -bg`` or ``-bga``.
+
+    The number of positions of each line is its interval length. Genomic
+    positions are not parsed, as each line spans multiple positions.
+
+    :param chunk: complete lines of bedGraph output
+    :type chunk: str
+    :rtype: ParsedChunk
+
+    """
+    buf, line_starts, line_ends = find_lines(chunk, skip_headers=True)
+    if not len(line_ends):
+        return ParsedChunk([], line_ends, line_ends, line_ends, None)
+
+    values, tabs = parse_int_field(buf, line_ends)
+    ends, tabs = parse_int_field(buf, tabs)
+    starts, _ = parse_int_field(buf, tabs)
+    lengths = ends - starts
+    if (lengths < 0).any():
+        raise ValueError("Interval end before start in input")
+    run_starts, first_tabs = find_name_runs(buf, line_starts)
+    run_names = [chunk[line_starts[i]:first_tabs[i]] for i in run_starts]
+
+    return ParsedChunk(run_names, run_starts, values, lengths, None)
+
+
+def add_histogram(hists, name, counts):
+    """Adds counts to the dense array (e.g. coverage histogram) of the given
+    name.
+
+    :param hists: arrays per name
+    :type hists: dict of numpy.ndarray
+    :param name: histogram name
+    :type name: str
+    :param counts: number of positions per coverage value
+    :type counts: numpy.ndarray
+
+    """
+    hist = hists.get(name)
+    if hist is None:
+        hists[name] = counts.astype(np.int64)
+    elif len(hist) < len(counts):
+        counts = counts.astype(np.int64)
+        counts[:len(hist)] += hist
+        hists[name] = counts
+    else:
+        hist[:len(counts)] += counts
+
+
+def counter_to_histogram(counter):
+    """Converts a Counter of coverage values into a histogram array."""
+    hist = np.zeros(max(counter) + 1, dtype=np.int64)
+    for cvg, count in counter.items():
+        hist[cvg] = count
+    return hist
+
+
+def histogram_to_counter(hist):
+    """Converts a histogram array into a Counter of its nonzero counts."""
+    values = np.flatnonzero(hist)
+    return collections.Counter(dict(zip(values.tolist(),
+        hist[values].tolist())))
+
+
+class HistogramTable(object):
+
+    """Class representing coverage histograms of many items, stored together
+    as sorted arrays of (item ID, coverage) keys and their counts."""
+
+    # number of pending keys at which they are merged into the table
+    compact_size = 1 << 22
+
+    def __init__(self):
+        self._keys = np.zeros(0, dtype=np.int64)
+        self._counts = np.zeros(0, dtype=np.int64)
+        self._pending = []
+        self._n_pending = 0
+
+    @staticmethod
+    def _reduce(keys, counts):
+        """Sorts keys and sums the counts of equal keys."""
+        order = np.argsort(keys, kind='mergesort')
+        keys, counts = keys[order], counts[order]
+        if not len(keys):
+            return keys, counts
+        starts = np.flatnonzero(np.concatenate(([True],
+            keys[1:] != keys[:-1])))
+        return keys[starts], np.add.reduceat(counts, starts)
+
+    def add(self, ids, values, weights=None):
+        """Adds coverage values to the histograms of the given item IDs.
+
+        :param ids: item ID of each coverage value
+        :type ids: numpy.ndarray
+        :param values: coverage values
+        :type values: numpy.ndarray
+        :param weights: number of positions of each value (default: 1)
+        :type weights: numpy.ndarray
+
+        """
+        if len(values) and values.max() >= 1 << 32:
+            raise ValueError("Coverage value too large: %r" % values.max())
+        keys = (ids.astype(np.int64) << 32) | values
+        if weights is None:
+            weights = np.ones(len(keys), dtype=np.int64)
+        keys, counts = self._reduce(keys, weights.astype(np.int64))
+        self._pending.append((keys, counts))
+        self._n_pending += len(keys)
+        if self._n_pending >= self.compact_size:
+            self.compact()
+
+    def merge(self, other):
+        """Adds the histograms of another table."""
+        other.compact()
+        self._pending.append((other._keys, other._counts))
+        self.compact()
+
+    def compact(self):
+        """Merges pending keys into the table."""
+        if not self._pending:
+            return
+        keys, counts = zip(*self._pending)
+        self._keys, self._counts = self._reduce(
+                np.concatenate((self._keys,) + keys),
+                np.concatenate((self._counts,) + counts))
+        self._pending = []
+        self._n_pending = 0
+
+    def __iter__(self):
+        """Yields the ID, coverage values and counts of each item with a
+        nonempty histogram, in order of ID."""
+        self.compact()
+        if not len(self._keys):
+            return
+        ids = self._keys >> 32
+        values = self._keys & 0xFFFFFFFF
+        bounds = np.flatnonzero(np.diff(ids)) + 1
+        for start, end in zip(np.concatenate(([0], bounds)),
+                np.concatenate((bounds, [len(ids)]))):
+            yield int(ids[start]), values[start:end], self._counts[start:end]
+
+    def histograms(self):
+        """Yields the ID and coverage histogram (indexed by coverage value)
+        of each item with a nonempty histogram."""
+        for item_id, values, counts in self:
+            hist = np.zeros(values[-1] + 1, dtype=np.int64)
+            hist[values] = counts
+            yield item_id, hist
+
+
+class Histograms(object):
+
+    """Class representing the coverage histograms of named sequences
+    (chromosomes, contigs or regions), stored together in a single histogram
+    table indexed by name ID.
+
+    Only the distinct coverage values of each name are stored, so memory
+    usage does not grow with the maximum coverage of each name, which keeps
+    assemblies with many contigs compact.
+
+    """
+
+    # minimum mean number of lines per chromosome run of a parsed chunk for
+    # which each run is counted separately instead of all runs at once
+    min_run_lines = 1 << 12
+
+    def __init__(self, names=()):
+        """
+
+        :param names: names to assign the first IDs to
+        :type names: list of str
+
+        """
+        self.names = []
+        self._ids = {}
+        self.table = HistogramTable()
+        for name in names:
+            self.name_id(name)
+
+    def name_id(self, name):
+        """Returns the ID of a name, assigning a new one if needed."""
+        name_id = self._ids.get(name)
+        if name_id is None:
+            name_id = self._ids[name] = len(self.names)
+            self.names.append(name)
+        return name_id
+
+    def add(self, name, counts):
+        """Adds coverage counts to the histogram of the given name.
+
+        :param name: histogram name
+        :type name: str
+        :param counts: number of positions per coverage value
+        :type counts: numpy.ndarray
+
+        """
+        values = np.flatnonzero(counts)
+        if len(values):
+            ids = np.empty(len(values), dtype=np.int64)
+            ids.fill(self.name_id(name))
+            self.table.add(ids, values, counts[values])
+
+    def add_parsed(self, parsed):
+        """Adds the coverage values of a parsed chunk to the histograms of
+        their chromosomes."""
+        if not len(parsed.names):
+            return
+        if len(parsed.values) >= len(parsed.names) * self.min_run_lines:
+            # long chromosome runs are counted one at a time
+            for name, start, end in iter_runs(parsed):
+                if parsed.weights is None:
+                    counts = np.bincount(parsed.values[start:end])
+                else:
+                    counts = np.bincount(parsed.values[start:end],
+                            weights=parsed.weights[start:end])
+                self.add(name, counts.round().astype(np.int64))
+        else:
+            # many short chromosomes (contigs) per chunk are added at once
+            run_ids = np.array([self.name_id(name) for name in parsed.names],
+                    dtype=np.int64)
+            lengths = np.diff(np.append(parsed.run_starts, len(parsed.values)))
+            self.table.add(np.repeat(run_ids, lengths), parsed.values,
+                    parsed.weights)
+
+    def merge(self, other):
+        """Adds the histograms of another histogram collection."""
+        ids = np.array([self.name_id(name) for name in other.names],
+                dtype=np.int64)
+        for other_id, values, counts in other.table:
+            self.table.add(np.repeat(ids[other_id], len(values)), values,
+                    counts)
+
+    def items(self):
+        """Yields the name and coverage histogram (indexed by coverage value)
+        of each name with a nonempty histogram."""
+        for name_id, hist in self.table.histograms():
+            yield self.names[name_id], hist
+
+    def total(self):
+        """Returns the sum of all histograms."""
+        self.table.compact()
+        values = self.table._keys & 0xFFFFFFFF
+        hist = np.zeros(values.max() + 1 if len(values) else 0,
+                dtype=np.int64)
+        np.add.at(hist, values, self.table._counts)
+        return hist
+
+    def quick_stats(self, thresholds=THRESHOLDS):
+        """Returns the quick coverage statistics of each name with a nonempty
+        histogram, as columns.
+
+        The statistics are the same as those of
+        ``Coverage.get_quick_stats``, but they are computed for all names at
+        once with array operations on the histogram table, without creating
+        an object per name. Undefined values are NaN.
+
+        :param thresholds: coverage values for which the fraction of bases
+            covered at least that many times is reported
+        :type thresholds: list of ints
+        :returns: names, and statistic name and values of each column
+        :rtype: tuple of (list, collections.OrderedDict)
+
+        """
+        table = self.table
+        table.compact()
+        keys, counts = table._keys, table._counts
+        ids, values = keys >> 32, keys & 0xFFFFFFFF
+        starts = np.flatnonzero(np.concatenate(([True], ids[1:] != ids[:-1])))
+        ends = np.append(starts[1:], len(keys))
+        names = [self.names[i] for i in ids[starts]]
+        if not len(keys):
+            return names, collections.OrderedDict()
+        seg = np.repeat(np.arange(len(starts)), ends - starts)
+
+        cum = np.cumsum(counts)
+        # number of bases of the preceding names
+        offsets = cum[starts] - counts[starts]
+        width = cum[ends - 1] - offsets
+        nonzero = width - np.where(values[starts] == 0, counts[starts], 0)
+        fvalues, fcounts = values.astype(np.float64), counts.astype(np.float64)
+        total = np.add.reduceat(values * counts, starts)
+        mean = total / width.astype(np.float64)
+        sum_sq = np.add.reduceat(fvalues * fvalues * fcounts, starts)
+        stdev = np.sqrt(np.maximum(sum_sq / width - mean ** 2, 0.0))
+
+        def value_at(rank):
+            return values[np.searchsorted(cum, offsets + rank, side='right')]
+
+        def percentile(q):
+            rank = q / 100.0 * (width - 1)
+            lower = np.floor(rank).astype(np.int64)
+            frac = rank - lower
+            upper = np.minimum(lower + 1, width - 1)
+            return value_at(lower) * (1 - frac) + value_at(upper) * frac
+
+        def bases_below(limits, side='left'):
+            # number of bases of each name with coverage below the limits
+            # (or up to, with side 'right')
+            idx = np.searchsorted(keys, (ids[starts] << 32) + limits, side)
+            return np.where(idx > 0, cum[idx - 1], 0) - offsets
+
+        # bases of each coverage value ranked after the preceding values
+        prev = cum - counts - offsets[seg]
+        weighted = np.add.reduceat(fvalues * (fcounts * prev +
+            fcounts * (fcounts + 1) / 2), starts)
+        pct20 = percentile(20)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            columns = collections.OrderedDict([
+                ('width', width),
+                ('width_nonzero', nonzero),
+                ('total', total),
+                ('mean', mean),
+                ('median', percentile(50)),
+                ('max', values[ends - 1]),
+                ('horizontal', nonzero / width.astype(np.float64)),
+            ])
+            for threshold in thresholds:
+                below = bases_below(max(threshold, 0))
+                columns['frac_min_{0}x'.format(threshold)] = \
+                        (width - below) / width.astype(np.float64)
+            within = bases_below(np.floor(1.2 * mean).astype(np.int64),
+                    'right') - bases_below(np.ceil(0.8 * mean).astype(
+                        np.int64))
+            columns.update([
+                ('cv', np.where(total > 0, stdev / mean, np.nan)),
+                ('fold_80_penalty', np.where(pct20 > 0, mean / pct20,
+                    np.nan)),
+                ('gini', np.where(total > 0, 2.0 * weighted / (width * total)
+                    - (width + 1.0) / width, np.nan)),
+                ('frac_within_20pct_mean', within / width.astype(np.float64)),
+            ])
+        return names, columns
+
+
+def write_stats_table(path, names, columns, fmt='tsv'):
+    """Writes per-name statistics as a tab-separated table, with a header
+    line, or as newline-delimited JSON, with one object per name.
+
+    :param path: path to the output file, or '-' for stdout
+    :type path: str
+    :param names: names, one per row
+    :type names: list of str
+    :param columns: statistic name and values of each column
+    :type columns: collections.OrderedDict
+    :param fmt: output format, 'tsv' or 'ndjson'
+    :type fmt: str
+
+    """
+    def convert(column):
+        # NaN (undefined) values are written as missing values
+        if column.dtype.kind == 'f':
+            return [None if math.isnan(x) else x for x in column.tolist()]
+        return column.tolist()
+
+    rows = zip(names, *[convert(c) for c in columns.values()])
+    handle = sys.stdout if path == '-' else open(path, 'w')
+    try:
+        if fmt == 'tsv':
+            handle.write('\t'.join(['name'] + list(columns)) + '\n')
+            for row in rows:
+                handle.write('\t'.join(['NA' if x is None else repr(x)
+                    if isinstance(x, float) else str(x) for x in row]) + '\n')
+        else:
+            keys = ['name'] + list(columns)
+            for row in rows:
+                handle.write(json.dumps(dict(zip(keys, row)),
+                    sort_keys=True) + '\n')
+    finally:
+        if handle is not sys.stdout:
+            handle.close()
+
+
+def parse_chunks(instream, chunk_parser, chunk_size=CHUNK_SIZE, size=None,
+        collectors=()):
+    """Builds per-chromosome coverage histograms from line-based coverage
+    output.
+
+    The input is read in large chunks which are parsed with NumPy array
+    operations, and the coverage values of each chromosome are added to its
+    histogram with ``np.bincount``, weighted by the number of positions of
+    each line. Memory usage depends on the chunk size and the maximum
+    coverage instead of the number of positions.
+
+    :param instream: handle of coverage output
+    :type instream: file
+    :param chunk_parser: function parsing a chunk of complete lines
+    :type chunk_parser: function
+    :param chunk_size: number of bytes to parse at a time
+    :type chunk_size: int
+    :param size: number of bytes to parse, or None to parse until the end
+        of the input
+    :type size: int
+    :param collectors: objects that also collect statistics from each parsed
+        chunk, through their ``add`` method
+    :type collectors: list
+    :returns: coverage histogram per chromosome
+    :rtype: Histograms
+
+    """
+    hists = Histograms()
+    positions = any(c.needs_positions for c in collectors)
+    for chunk in iter_chunks(instream, chunk_size, size):
+        parsed = chunk_parser(chunk, positions)
+        hists.add_parsed(parsed)
+        for collector in collectors:
+            collector.add(parsed)
+
+    return hists
+
+
+def parse_depth(instream, chunk_size=CHUNK_SIZE, size=None, collectors=()):
+    """Builds per-chromosome coverage histograms from coverageBed -d output.
+
+    See ``parse_chunks`` for the parameters.
+
+    """
+    return parse_chunks(instream, parse_depth_chunk, chunk_size, size,
+            collectors)
+
+
+def parse_bedgraph(instream, chunk_size=CHUNK_SIZE, size=None, collectors=()):
+    """Builds per-chromosome coverage histograms from bedGraph output, with
+    each interval weighted by its length.
+
+    Note that ``bedtools genomecov -bg`` does not report uncovered
+    intervals; use ``-bga`` to include them in the statistics. See
+    ``parse_chunks`` for the parameters.
+
+    """
+    return parse_chunks(instream, parse_bedgraph_chunk, chunk_size, size,
+            collectors)
+
+
+def parse_hist(instream, collectors=()):
+    """Builds per-chromosome coverage histograms from coverageBed -hist
+    output.
+
+    The histogram lines of each feature are summed per chromosome, with each
+    coverage value weighted by its number of bases. The summary lines of all
+    features are skipped, as the genome-wide histogram is computed from the
+    per-chromosome histograms.
+
+    :param instream: handle of coverageBed -hist output
+    :type instream: file
+    :param collectors: not supported, as the input has no positions
+    :type collectors: list
+    :returns: coverage histogram per chromosome
+    :rtype: Histograms
+
+    """
+    assert not collectors, "coverageBed -hist input has no positions"
+    counters = {}
+    for line in instream:
+        cols = line.rstrip('\r\n').split('\t')
+        # skip empty lines and the summary lines (all, depth, bases, size,
+        # fraction)
+        if len(cols) < 7:
+            continue
+        counter = counters.setdefault(cols[0], collections.Counter())
+        counter[int(cols[-4])] += int(cols[-3])
+
+    hists = Histograms()
+    for name, counter in counters.items():
+        hists.add(name, counter_to_histogram(counter))
+    return hists
+
+
+def iter_bed(path):
+    """Yields the chromosome, start, end and name of each region in a BED
+    file. Regions without a name are named after their coordinates."""
+    with open(path, 'r') as handle:
+        for line in handle:
+            if not line.strip() or line.startswith(HEADER_PREFIXES):
+                continue
+            cols = line.rstrip('\r\n').split('\t')
+            chrom, start, end = cols[0], int(cols[1]), int(cols[2])
+            if len(cols) > 3 and cols[3]:
+                name = cols[3]
+            else:
+                name = '{0}:{1}-{2}'.format(chrom, start, end)
+            yield chrom, start, end, name
+
+
+def bam_depth(bam, chrom, start, end):
+    """Computes the per-base depth of a region from a BAM file.
+
+    Depth is computed the same way as coverageBed does for BAM input: each
+    mapped alignment covers all bases from its start to its end, including
+    deletions and skipped regions.
+
+    :param bam: indexed BAM file
+    :type bam: pysam.Samfile
+    :param chrom: chromosome name
+    :type chrom: str
+    :param start: region start (0-based)
+    :type start: int
+    :param end: region end (exclusive)
+    :type end: int
+    :returns: depth of each base of the region
+    :rtype: numpy.ndarray
+
+    """
+    starts, ends = [], []
+    for rec in bam.fetch(chrom, start, end):
+        if rec.is_unmapped or rec.aend is None:
+            continue
+        starts.append(max(rec.pos, start) - start)
+        ends.append(min(rec.aend, end) - start)
+    length = end - start
+    # depth changes by +1 at each alignment start and -1 at each end
+    changes = np.bincount(np.array(starts, dtype=np.int64),
+            minlength=length + 1) - \
+            np.bincount(np.array(ends, dtype=np.int64), minlength=length + 1)
+    return np.cumsum(changes[:length])
+
+
+def parse_bam(bam_path, targets_path, collectors=()):
+    """Builds per-chromosome coverage histograms from a BAM file over the
+    regions of a BED file, without intermediate coverageBed output.
+
+    The histograms are the same as those from coverageBed -d output of the
+    BAM file on the regions.
+
+    :param bam_path: path to an indexed BAM file
+    :type bam_path: str
+    :param targets_path: path to a BED file of target regions
+    :type targets_path: str
+    :param collectors: objects that also collect statistics from the depth
+        of each block of target bases, through their ``add`` method
+    :type collectors: list
+    :returns: coverage histogram per chromosome
+    :rtype: Histograms
+
+    """
+    hists = Histograms()
+    bam = pysam.Samfile(bam_path, 'rb')
+    for chrom, start, end, _ in iter_bed(targets_path):
+        for block_start in range(start, end, BAM_BLOCK_SIZE):
+            block_end = min(block_start + BAM_BLOCK_SIZE, end)
+            depth = bam_depth(bam, chrom, block_start, block_end)
+            hists.add(chrom, np.bincount(depth))
+            if collectors:
+                parsed = ParsedChunk([chrom], np.zeros(1, dtype=np.int64),
+                        depth, None, np.arange(block_start, block_end))
+                for collector in collectors:
+                    collector.add(parsed)
+    bam.close()
+
+    return hists
+
+
+class PrefixedStream(io.RawIOBase):
+
+    """Raw stream that returns the given bytes before the rest of another
+    stream, to read bytes that were already taken from it again."""
+
+    def __init__(self, prefix, stream):
+        self._prefix = prefix
+        self._stream = stream
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        if self._prefix:
+            size = min(len(buf), len(self._prefix))
+            buf[:size] = self._prefix[:size]
+            self._prefix = self._prefix[size:]
+            return size
+        return self._stream.readinto(buf)
+
+    def close(self):
+        if not self.closed:
+            self._stream.close()
+        super(PrefixedStream, self).close()
+
+
+def header_format(header, eof):
+    """Returns the format name of coverage output from its first bytes, or
+    None if more bytes are needed.
+
+    Only complete lines are used, unless the end of the input is reached.
+
+    """
+    if not eof and len(header) < len(GZIP_MAGIC):
+        return None
+    if header.startswith(GZIP_MAGIC):
+        content = zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(header)
+        if len(content) < len(BAM_MAGIC) and not eof:
+            return None
+        if content.startswith(BAM_MAGIC):
+            return 'bam'
+        raise ValueError("Compressed coverage output is not supported, "
+                "it must be decompressed first")
+    lines = header.split(b'\n')
+    # the last line is incomplete, unless the input has ended
+    if not eof:
+        lines.pop()
+    for line in lines:
+        if not line.strip() or line.startswith(HEADER_PREFIXES):
+            continue
+        cols = line.rstrip(b'\r').split(b'\t')
+        # coverageBed -hist ends with the fraction of bases at each depth
+        if b'.' in cols[-1]:
+            return 'hist'
+        elif len(cols) == 4:
+            return 'bedgraph'
+        return 'depth'
+    # empty input
+    return 'depth' if eof else None
+
+
+def detect_format(instream):
+    """Detects the format of coverage output from its first line.
+
+    The stream is read until its first line is complete, so the input must
+    be read from the returned handle instead (the same handle, rewound, if
+    it is seekable).
+
+    :param instream: handle of coverage output
+    :type instream: io.BufferedReader
+    :returns: input format name (see ``PARSERS``) and a handle of the
+        complete input
+    :rtype: tuple
+
+    """
+    header = b''
+    fmt = None
+    while fmt is None:
+        data = instream.read1(io.DEFAULT_BUFFER_SIZE)
+        header += data
+        fmt = header_format(header, eof=not data)
+    if instream.seekable():
+        instream.seek(0)
+        return fmt, instream
+    return fmt, io.BufferedReader(PrefixedStream(header, instream))
+
+
+def split_lines(path, n_parts):
+    """Splits a file into byte ranges of about equal size that start and
+    end at line boundaries.
+
+    :param path: path to the file
+    :type path: str
+    :param n_parts: number of ranges to split the file into
+    :type n_parts: int
+    :returns: start and end (exclusive) offsets of each range
+    :rtype: list of tuples
+
+    """
+    size = os.path.getsize(path)
+    bounds = [0]
+    with open(path, 'rb') as handle:
+        for part in range(1, n_parts):
+            offset = size * part // n_parts
+            if offset <= bounds[-1]:
+                continue
+            # move to the start of the line following the offset
+            handle.seek(offset - 1)
+            handle.readline()
+            bounds.append(handle.tell())
+    bounds.append(size)
+
+    return [(start, end) for start, end in zip(bounds, bounds[1:])
+            if start < end]
+
+
+def _parse_range(args):
+    """Builds coverage histograms from a byte range of coverage output, for
+    use in a process pool."""
+    path, fmt, start, end, collectors = args
+    with open(path, 'rb') as handle:
+        handle.seek(start)
+        hists = PARSERS[fmt](handle, size=end - start, collectors=collectors)
+    return hists, collectors
+
+
+def merge_histograms(hists_list):
+    """Merges coverage histograms of the same names.
+
+    :param hists_list: coverage histograms per name
+    :type hists_list: iterable of Histograms
+    :returns: summed coverage histogram per name
+    :rtype: Histograms
+
+    """
+    merged = Histograms()
+    for hists in hists_list:
+        merged.merge(hists)
+    return merged
+
+
+def parse_parallel(path, fmt, processes, collectors=()):
+    """Builds per-chromosome coverage histograms from a coverage output file
+    using multiple processes.
+
+    The file is split at line boundaries into one byte range per process.
+    Each range is parsed into partial histograms, which are then summed per
+    chromosome, so chromosomes that span multiple ranges are merged. Each
+    process fills its own copy of the collectors, which are then merged into
+    the given collectors through their ``merge`` method.
+
+    :param path: path to coverage output
+    :type path: str
+    :param fmt: input format name (see ``PARSERS``)
+    :type fmt: str
+    :param processes: number of processes to use
+    :type processes: int
+    :param collectors: objects that also collect statistics from each parsed
+        chunk
+    :type collectors: list
+    :returns: coverage histogram per chromosome
+    :rtype: Histograms
+
+    """
+    tasks = [(path, fmt, start, end, collectors)
+            for start, end in split_lines(path, processes)]
+    pool = multiprocessing.Pool(processes)
+    try:
+        partials = pool.map(_parse_range, tasks)
+    finally:
+        pool.terminate()
+    for _, partial_collectors in partials:
+        for collector, partial in zip(collectors, partial_collectors):
+            collector.merge(partial)
+    return merge_histograms(hists for hists, _ in partials)
+
+
+class RegionIndex(object):
+
+    """Class representing a sorted interval index of named regions.
+
+    Each chromosome is split into segments at all region boundaries, and
+    each segment is linked to the names of the regions that contain it, so
+    positions are assigned to regions with a binary search. Positions are
+    counted once per name, also when regions of the same name overlap.
+
+    """
+
+    def __init__(self, regions):
+        """
+
+        :param regions: chromosome, start, end and name of each region
+        :type regions: iterable
+
+        """
+        self.names = []
+        name_ids = {}
+        by_chrom = {}
+        for chrom, start, end, name in regions:
+            if name not in name_ids:
+                name_ids[name] = len(self.names)
+                self.names.append(name)
+            if start < end:
+                by_chrom.setdefault(chrom, []).append(
+                        (start, end, name_ids[name]))
+
+        # per chromosome: segment boundaries, and the name IDs of each
+        # segment as slices (from segment pointers) of a single array
+        self._index = {}
+        for chrom, intervals in by_chrom.items():
+            bounds = sorted(set(x for start, end, _ in intervals
+                for x in (start, end)))
+            events = collections.defaultdict(list)
+            for start, end, name_id in intervals:
+                events[start].append((name_id, 1))
+                events[end].append((name_id, -1))
+            active = collections.Counter()
+            seg_ptr, seg_ids = [0], []
+            for bound in bounds[:-1]:
+                for name_id, change in events[bound]:
+                    active[name_id] += change
+                seg_ids.extend(sorted(i for i, n in active.items() if n > 0))
+                seg_ptr.append(len(seg_ids))
+            self._index[chrom] = (np.array(bounds, dtype=np.int64),
+                    np.array(seg_ptr, dtype=np.int64),
+                    np.array(seg_ids, dtype=np.int64))
+
+    @classmethod
+    def from_bed(cls, path):
+        """Creates a region index from the regions of a BED file."""
+        return cls(iter_bed(path))
+
+    def lookup(self, chrom, positions):
+        """Assigns positions to the regions that contain them.
+
+        :param chrom: chromosome name
+        :type chrom: str
+        :param positions: 0-based positions
+        :type positions: numpy.ndarray
+        :returns: index of the position and name ID of each (position,
+            region name) pair
+        :rtype: tuple of (numpy.ndarray, numpy.ndarray)
+
+        """
+        if chrom not in self._index:
+            empty = np.zeros(0, dtype=np.int64)
+            return empty, empty
+        bounds, seg_ptr, seg_ids = self._index[chrom]
+        segs = np.searchsorted(bounds, positions, side='right') - 1
+        inside = (segs >= 0) & (segs < len(bounds) - 1)
+        segs = np.where(inside, segs, 0)
+        n_ids = np.where(inside, seg_ptr[segs + 1] - seg_ptr[segs], 0)
+        idx = np.repeat(np.arange(len(positions)), n_ids)
+        # offset of each pair within the name IDs of its segment
+        firsts = np.cumsum(n_ids) - n_ids
+        within = np.arange(len(idx)) - np.repeat(firsts, n_ids)
+        return idx, seg_ids[np.repeat(seg_ptr[segs], n_ids) + within]
+
+
+class RegionCoverage(object):
+
+    """Class collecting coverage histograms per region name."""
+
+    needs_positions = True
+
+    def __init__(self, index):
+        """
+
+        :param index: regions to collect coverage for
+        :type index: RegionIndex
+
+        """
+        self.index = index
+        self.hists = Histograms(index.names)
+
+    def add(self, parsed):
+        """Adds the coverage of each position of a parsed chunk to the
+        histograms of its regions."""
+        for chrom, start, end in iter_runs(parsed):
+            idx, name_ids = self.index.lookup(chrom,
+                    parsed.positions[start:end])
+            if len(idx):
+                self.hists.table.add(name_ids,
+                        parsed.values[start:end][idx])
+
+    def merge(self, other):
+        """Adds the histograms collected by another region collector."""
+        self.hists.table.merge(other.hists.table)
+
+
+class WindowCoverage(object):
+
+    """Class collecting the coverage sum, number of bases and number of
+    covered (nonzero) bases in fixed-size windows of each chromosome."""
+
+    needs_positions = True
+
+    def __init__(self, window_size=WINDOW_SIZE):
+        """
+
+        :param window_size: number of bases per window
+        :type window_size: int
+
+        """
+        self.window_size = window_size
+        # per chromosome, in input order: arrays indexed by window
+        self.sums = collections.OrderedDict()
+        self.bases = collections.OrderedDict()
+        self.nonzero = collections.OrderedDict()
+        self.ends = {}
+
+    def add(self, parsed):
+        """Adds the coverage of each position of a parsed chunk to its
+        window."""
+        for chrom, start, end in iter_runs(parsed):
+            positions = parsed.positions[start:end]
+            values = parsed.values[start:end]
+            windows = positions // self.window_size
+            add_histogram(self.sums, chrom, np.bincount(windows,
+                weights=values).round().astype(np.int64))
+            add_histogram(self.bases, chrom, np.bincount(windows))
+            add_histogram(self.nonzero, chrom, np.bincount(windows,
+                weights=values > 0).astype(np.int64))
+            self.ends[chrom] = max(self.ends.get(chrom, 0),
+                    int(positions.max()) + 1)
+
+    def merge(self, other):
+        """Adds the windows collected by another window collector."""
+        for name in other.sums:
+            add_histogram(self.sums, name, other.sums[name])
+            add_histogram(self.bases, name, other.bases[name])
+            add_histogram(self.nonzero, name, other.nonzero[name])
+            self.ends[name] = max(self.ends.get(name, 0), other.ends[name])
+
+    def write_bedgraph(self, path, covered=False):
+        """Writes the mean coverage, or the fraction of covered bases, of
+        each window with coverage data as a bedGraph file.
+
+        Both are taken over the bases present in the input, and the last
+        window of each chromosome ends at the last base in the input.
+
+        :param path: path to the output file
+        :type path: str
+        :param covered: whether to write the fraction of bases with nonzero
+            coverage instead of the mean coverage
+        :type covered: bool
+
+        """
+        if covered:
+            name, totals, line = 'covered fraction', self.nonzero, \
+                    '%s\t%d\t%d\t%.4f\n'
+        else:
+            name, totals, line = 'mean coverage', self.sums, \
+                    '%s\t%d\t%d\t%.2f\n'
+        with open(path, 'w') as handle:
+            handle.write('track type=bedGraph name="%s"\n' % name)
+            for chrom, chrom_totals in totals.items():
+                bases = self.bases[chrom]
+                for window in np.flatnonzero(bases):
+                    start = window * self.window_size
+                    end = min(start + self.window_size, self.ends[chrom])
+                    handle.write(line % (chrom, start, end,
+                        float(chrom_totals[window]) / bases[window]))
+
+
+class CoverageCache(object):
+
+    """Class representing an on-disk cache of per-base coverage.
+
+    The coverage of each chromosome is stored as a raw uint16 array, or
+    uint32 if it has higher coverage values, in input order. Positions are
+    stored as runs of consecutive bases, giving the line index and position
+    at which each run starts. The cache is filled as a collector while the
+    input is parsed, and committed with an index file recording the input
+    it was built from.
+
+    """
+
+    needs_positions = True
+    index_name = 'index.json'
+
+    def __init__(self, path):
+        """
+
+        :param path: path to the cache directory
+        :type path: str
+
+        """
+        self.path = path
+        self.chroms = collections.OrderedDict()
+        self.directory = None
+
+    @classmethod
+    def load(cls, path, source=None):
+        """Opens a committed cache, if it exists and was built from the given
+        input.
+
+        :param path: path to the cache directory
+        :type path: str
+        :param source: description of the input, or None to open the cache
+            regardless of its input
+        :type source: dict
+        :returns: cache, or None if there is no valid cache
+        :rtype: CoverageCache
+
+        """
+        try:
+            with open(os.path.join(path, cls.index_name), 'r') as handle:
+                index = json.load(handle)
+        except (IOError, ValueError):
+            return None
+        if index.get('format') != CACHE_FORMAT or \
+                index.get('version') != CACHE_VERSION or \
+                (source is not None and index.get('source') != source):
+            return None
+        cache = cls(path)
+        cache.directory = os.path.join(path, index['directory'])
+        cache.chroms.update((str(name), entry)
+                for name, entry in index['chromosomes'])
+        return cache
+
+    def _file(self, entry):
+        return os.path.join(self.directory, entry['file'])
+
+    def add(self, parsed):
+        """Appends the coverage and positions of a parsed chunk."""
+        for chrom, start, end in iter_runs(parsed):
+            self._append(chrom, parsed.values[start:end],
+                    parsed.positions[start:end])
+
+    def _append(self, chrom, values, positions):
+        if self.directory is None:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            self.directory = tempfile.mkdtemp(prefix='cache.', dir=self.path)
+        entry = self.chroms.get(chrom)
+        if entry is None:
+            entry = self.chroms[chrom] = {'file': '%d.cov' % len(self.chroms),
+                    'dtype': 'uint16', 'length': 0, 'runs': []}
+        if values.max() > np.iinfo(entry['dtype']).max:
+            if values.max() > np.iinfo(np.uint32).max:
+                raise ValueError("Coverage value too large to cache: %r" %
+                        values.max())
+            # widen the cached coverage of the chromosome
+            if entry['dtype'] == 'uint16':
+                path = self._file(entry)
+                if entry['length']:
+                    widened = np.fromfile(path, dtype=np.uint16)
+                    widened.astype(np.uint32).tofile(path)
+                entry['dtype'] = 'uint32'
+
+        # start a run at each base that does not follow the previous base
+        breaks = np.flatnonzero(np.diff(positions) != 1) + 1
+        if entry['runs'] and entry['runs'][-1][1] + entry['length'] - \
+                entry['runs'][-1][0] == positions[0]:
+            run_starts = breaks
+        else:
+            run_starts = np.concatenate(([0], breaks))
+        entry['runs'].extend([entry['length'] + int(i), int(positions[i])]
+                for i in run_starts)
+
+        with open(self._file(entry), 'ab') as handle:
+            values.astype(entry['dtype']).tofile(handle)
+        entry['length'] += len(values)
+
+    @staticmethod
+    def _positions(runs, start, end):
+        """Returns the positions of the cached bases from start to end
+        (exclusive), given the line index and position of each run."""
+        idx = np.arange(start, end)
+        run = np.searchsorted(runs[:, 0], idx, side='right') - 1
+        return runs[run, 1] + idx - runs[run, 0]
+
+    def _iter_blocks(self, chrom, positions=False):
+        """Yields parsed chunks of the cached coverage of a chromosome."""
+        entry = self.chroms[chrom]
+        if not entry['length']:
+            return
+        depth = np.memmap(self._file(entry), dtype=entry['dtype'], mode='r',
+                shape=(entry['length'],))
+        runs = np.array(entry['runs'], dtype=np.int64).reshape(-1, 2)
+        for start in range(0, entry['length'], CACHE_BLOCK_SIZE):
+            end = min(start + CACHE_BLOCK_SIZE, entry['length'])
+            yield ParsedChunk([chrom], np.zeros(1, dtype=np.int64),
+                    depth[start:end].astype(np.int64), None,
+                    self._positions(runs, start, end) if positions else None)
+
+    def merge(self, other):
+        """Appends the coverage cached by another cache collector, and
+        removes its files."""
+        for chrom in other.chroms:
+            for parsed in other._iter_blocks(chrom, positions=True):
+                self._append(chrom, parsed.values, parsed.positions)
+        if other.directory is not None:
+            shutil.rmtree(other.directory)
+
+    def commit(self, source):
+        """Writes the index of the cache, replacing any previous cache.
+
+        :param source: description of the input
+        :type source: dict
+
+        """
+        previous = CoverageCache.load(self.path)
+        index = {
+            'format': CACHE_FORMAT,
+            'version': CACHE_VERSION,
+            'source': source,
+            'directory': os.path.basename(self.directory),
+            'chromosomes': list(self.chroms.items()),
+        }
+        index_path = os.path.join(self.path, self.index_name)
+        with open(index_path + '.tmp', 'w') as handle:
+            json.dump(index, handle)
+        os.rename(index_path + '.tmp', index_path)
+        if previous is not None and previous.directory != self.directory:
+            shutil.rmtree(previous.directory, ignore_errors=True)
+
+    def parse(self, collectors=()):
+        """Builds per-chromosome coverage histograms from the cache.
+
+        :param collectors: objects that also collect statistics from each
+            block of cached coverage, through their ``add`` method
+        :type collectors: list
+        :returns: coverage histogram per chromosome
+        :rtype: Histograms
+
+        """
+        hists = Histograms()
+        positions = any(c.needs_positions for c in collectors)
+        for chrom in self.chroms:
+            for parsed in self._iter_blocks(chrom, positions):
+                hists.add_parsed(parsed)
+                for collector in collectors:
+                    collector.add(parsed)
+        return hists
+
+
+def dump_histograms(path, hists, region_hists=None):
+    """Saves coverage histograms to a JSON file.
+
+    Only the nonzero counts of each histogram are saved, together with its
+    total and nonzero number of bases, so the file size depends on the
+    number of distinct coverage values instead of the number of bases.
+
+    :param path: path to the output file
+    :type path: str
+    :param hists: coverage histogram per chromosome
+    :type hists: Histograms
+    :param region_hists: coverage histogram per region name, if any
+    :type region_hists: Histograms
+
+    """
+    def encode(hist):
+        values = np.flatnonzero(hist)
+        return {
+            'values': values.tolist(),
+            'counts': hist[values].tolist(),
+            'width': int(hist.sum()),
+            'width_nonzero': int(hist[1:].sum()),
+        }
+
+    data = {
+        'format': HISTOGRAM_FORMAT,
+        'version': HISTOGRAM_VERSION,
+        'coverage': {k: encode(v) for k, v in hists.items()},
+    }
+    if region_hists is not None:
+        data['regions'] = {k: encode(v) for k, v in region_hists.items()}
+    with open(path, 'w') as handle:
+        json.dump(data, handle, sort_keys=True, separators=(',', ':'))
+
+
+def load_histograms(path):
+    """Loads coverage histograms saved by ``dump_histograms``.
+
+    :param path: path to the histogram file
+    :type path: str
+    :returns: coverage histogram per chromosome, and coverage histogram per
+        region name (None if no regions were saved)
+    :rtype: tuple of (Histograms, Histograms)
+
+    """
+    def decode(entry):
+        values = np.array(entry['values'], dtype=np.int64)
+        counts = np.array(entry['counts'], dtype=np.int64)
+        if len(values) != len(counts) or (values < 0).any() or \
+                counts.sum() != entry['width'] or \
+                counts[values > 0].sum() != entry['width_nonzero']:
+            raise ValueError("Invalid histogram in %r" % path)
+        hist = np.zeros(values.max() + 1 if len(values) else 0,
+                dtype=np.int64)
+        np.add.at(hist, values, counts)
+        return hist
+
+    with open(path, 'r') as handle:
+        try:
+            data = json.load(handle)
+        except ValueError:
+            data = None
+    if not isinstance(data, dict) or data.get('format') != HISTOGRAM_FORMAT:
+        raise ValueError("Not a coverage histogram file: %r" % path)
+    if data.get('version') != HISTOGRAM_VERSION:
+        raise ValueError("Unsupported histogram file version %r in %r" %
+                (data.get('version'), path))
+    hists = Histograms()
+    for name, entry in sorted(data['coverage'].items()):
+        hists.add(str(name), decode(entry))
+    region_hists = None
+    if 'regions' in data:
+        region_hists = Histograms()
+        for name, entry in sorted(data['regions'].items()):
+            region_hists.add(str(name), decode(entry))
+    return hists, region_hists
+
+
+# parsers of each input format
+PARSERS = {
+    'depth': parse_depth,
+    'bedgraph': parse_bedgraph,
+    'hist': parse_hist,
+}
+
+
 class Coverage(object):
 
     """Class representing coverage metrics from a coverageBed -d output."""
@@ -109,6 +1574,21 @@ class Coverage(object):
         self.total_bases = total_bases
         self.nonzero_bases = nonzero_bases
 
+    @classmethod
+    def from_counter(cls, counter, name='?'):
+        """Creates a coverage object from a precomputed coverage histogram.
+
+        :param counter: mapping of coverage value to number of positions
+        :type counter: collections.Counter
+
+        """
+        assert counter
+        obj = cls.__new__(cls)
+        obj._counter = counter
+        obj.total_bases = sum(counter.values())
+        obj.nonzero_bases = obj.total_bases - counter.get(0, 0)
+        return obj
+
     def __iter__(self):
         return self._counter.iteritems()
 
@@ -135,27 +1615,157 @@ class Coverage(object):
         """Maximum coverage."""
         return max(self._counter.keys())
 
+    @cachedproperty
+    def min(self):
+        """Minimum coverage."""
+        return min(self._counter.keys())
+
     @cachedproperty
     def median(self):
         """Median coverage."""
-        return np.percentile(self.cov_counts, 50)
+        return self.percentile(50)
 
     @cachedproperty
-    def cov_counts(self):
-        """List of coverage for each base position (unsorted)."""
-        # get list of each base coverage
-        cov_counts = ([key] * value for key, value in self._counter.items())
-        # and flatten the list
-        return [item for sublist in cov_counts for item in sublist]
+    def sorted_counts(self):
+        """Tuple of coverage values and their cumulative counts, sorted by
+        coverage."""
+        values, cum_counts = [], []
+        cum = 0
+        for cvg, count in sorted(self._counter.items()):
+            cum += count
+            values.append(cvg)
+            cum_counts.append(cum)
+        return values, cum_counts
+
+    @cachedproperty
+    def stdev(self):
+        """Standard deviation of the per-base coverage."""
+        sum_sq = sum([cvg * cvg * count for cvg, count in self])
+        variance = float(sum_sq) / self.total_bases - self.mean ** 2
+        return math.sqrt(max(variance, 0.0))
+
+    @cachedproperty
+    def cv(self):
+        """Coefficient of variation of the per-base coverage, or None if
+        there is no coverage."""
+        if not self.total:
+            return None
+        return self.stdev / self.mean
+
+    @cachedproperty
+    def fold_80_penalty(self):
+        """Fold-80 base penalty: the fold of additional sequencing needed to
+        raise 80% of the bases to the mean coverage (mean coverage divided by
+        the 20th percentile), or None if the 20th percentile is zero."""
+        pct20 = self.percentile(20)
+        if not pct20:
+            return None
+        return self.mean / pct20
+
+    @cachedproperty
+    def gini(self):
+        """Gini coefficient of the per-base coverage (0 for perfectly even
+        coverage), or None if there is no coverage."""
+        if not self.total:
+            return None
+        # sum of rank * coverage over all bases sorted by coverage, where the
+        # bases of each coverage value have consecutive (1-based) ranks
+        weighted, prev = 0, 0
+        for cvg, cum in zip(*self.sorted_counts):
+            count = cum - prev
+            weighted += cvg * (count * prev + count * (count + 1) // 2)
+            prev = cum
+        n = self.total_bases
+        return 2.0 * weighted / (n * self.total) - float(n + 1) / n
+
+    @cachedproperty
+    def frac_within_20pct_mean(self):
+        """Fraction of bases with a coverage within 20% of the mean."""
+        values, cum_counts = self.sorted_counts
+        lo = bisect.bisect_left(values, 0.8 * self.mean)
+        hi = bisect.bisect_right(values, 1.2 * self.mean)
+        below = cum_counts[lo - 1] if lo > 0 else 0
+        upto = cum_counts[hi - 1] if hi > 0 else 0
+        return float(upto - below) / self.total_bases
+
+    def value_at(self, rank):
+        """Returns the coverage of the base at the given 0-based rank when
+        all bases are sorted by coverage."""
+        values, cum_counts = self.sorted_counts
+        return values[bisect.bisect_right(cum_counts, rank)]
+
+    def percentile(self, q):
+        """Returns the q-th percentile of the per-base coverage.
+
+        The result is the same as ``np.percentile`` (linear interpolation)
+        on the per-base coverage list, but it is computed by walking the
+        cumulative counts of the histogram.
+
+        """
+        rank = q / 100.0 * (self.total_bases - 1)
+        lower = int(math.floor(rank))
+        frac = rank - lower
+        lower_value = self.value_at(lower)
+        if frac == 0:
+            return float(lower_value)
+        upper_value = self.value_at(lower + 1)
+        return lower_value * (1 - frac) + upper_value * frac
+
+    def boxplot_stats(self, whis=1.5):
+        """Returns the boxplot statistics of the per-base coverage, in the
+        format accepted by matplotlib's ``Axes.bxp``.
+
+        Whiskers extend to the most extreme coverage within ``whis`` times
+        the interquartile range, the same way ``Axes.boxplot`` computes them.
+        Fliers are reported once per distinct coverage value, as repeated
+        values would be drawn on top of each other anyway.
+
+        :param whis: Whisker reach, in interquartile range (default: 1.5).
+        :type whis: float
+
+        """
+        q1, med, q3 = [self.percentile(q) for q in (25, 50, 75)]
+        iqr = q3 - q1
+        lo_val, hi_val = q1 - whis * iqr, q3 + whis * iqr
+        values = self.sorted_counts[0]
+
+        whishi = max([v for v in values if v <= hi_val] or [q3])
+        if whishi < q3:
+            whishi = q3
+        whislo = min([v for v in values if v >= lo_val] or [q1])
+        if whislo > q1:
+            whislo = q1
+        fliers = [v for v in values if v < whislo or v > whishi]
+
+        return {
+            'med': med,
+            'q1': q1,
+            'q3': q3,
+            'whislo': whislo,
+            'whishi': whishi,
+            'fliers': fliers,
+            'mean': self.mean,
+        }
 
     def at_least(self, n):
         """Return the percentages of bases covered at least n times."""
-        x = sum([count for cvg, count in self if cvg >= n])
-        return float(x) / self.total_bases
+        # bases covered at least n times are all bases minus those covered
+        # less than n times, taken from the cached cumulative counts
+        values, cum_counts = self.sorted_counts
+        idx = bisect.bisect_left(values, n)
+        below = cum_counts[idx - 1] if idx > 0 else 0
+        return float(self.total_bases - below) / self.total_bases
 
-    def get_quick_stats(self):
-        """Returns a dictionary containing quick coverage statistics."""
-        return {
+    def get_quick_stats(self, thresholds=THRESHOLDS):
+        """Returns a dictionary containing quick coverage statistics.
+
+        :param thresholds: Coverage values for which the fraction of bases
+            covered at least that many times is reported (default: 10, 20,
+            30, 40 and 50).
+        :type thresholds: list of ints
+
+        """
+        stats = {
             'max': self.max,
             'median': self.median,
             'mean': self.mean,
@@ -163,14 +1773,17 @@ class Coverage(object):
             'width': self.total_bases,
             'width_nonzero': self.nonzero_bases,
             'total': self.total,
-            'frac_min_10x': self.at_least(10),
-            'frac_min_20x': self.at_least(20),
-            'frac_min_30x': self.at_least(30),
-            'frac_min_40x': self.at_least(40),
-            'frac_min_50x': self.at_least(50),
+            'fold_80_penalty': self.fold_80_penalty,
+            'gini': self.gini,
+            'cv': self.cv,
+            'frac_within_20pct_mean': self.frac_within_20pct_mean,
         }
+        for threshold in thresholds:
+            stats['frac_min_{0}x'.format(threshold)] = self.at_least(threshold)
+        return stats
 
-    def plot(self, min_cov_ok=7, percentile_show=98, title=None, out_img=None):
+    def plot(self, min_cov_ok=7, percentile_show=98, title=None, out_img=None,
+            figure=None):
         """Plots the coverage object.
 
         :param min_cov_ok: Minimum coverage value to show in the bar graph
@@ -183,9 +1796,16 @@ class Coverage(object):
         :type title: list of strings (one item per line)
         :param out_img: Output image filename.
         :type out_img: str
+        :param figure: Figure to clear and plot in, instead of creating a new
+            figure.
+        :type figure: matplotlib.figure.Figure
 
         """
-        plt.figure(figsize=(8, 8))
+        if figure is None:
+            plt.figure(figsize=(8, 8))
+        else:
+            figure.clf()
+            plt.figure(figure.number)
         grids = gs.GridSpec(2, 1, height_ratios=[5, 1])
 
         ax0 = plt.subplot(grids[0])
@@ -220,24 +1840,25 @@ class Coverage(object):
 
         ax1 = plt.subplot(grids[1], sharex=ax0)
         ax1.axes.get_yaxis().set_visible(False)
-        bp = ax1.boxplot(self.cov_counts, vert=False, widths=0.6, sym='+')
+        bp = ax1.bxp([self.boxplot_stats()], vert=False, widths=0.6,
+                flierprops={'marker': '+'})
         for x in itertools.chain(bp['boxes'], bp['medians'], bp['whiskers'],
                 bp['caps']):
             x.set(color=BLUE, linewidth=1.6)
         for flier in bp['fliers']:
             plt.setp(flier, color='GREEN', alpha=0.5)
         
-        upper_limit = np.percentile(self.cov_counts, percentile_show)
+        upper_limit = self.percentile(percentile_show)
         if x_data:
             space = (upper_limit - min(x_data)) / 40
         else:
             space = 0
         # truncate plot if we're not displaying maximum value
         if upper_limit != self.max:
-            ax1.set_xlim([min(self.cov_counts) - space - 0.5, upper_limit + 0.5])
+            ax1.set_xlim([self.min - space - 0.5, upper_limit + 0.5])
         # otherwise, give some space
         else:
-            ax1.set_xlim([min(self.cov_counts) - space - 0.5, upper_limit +
+            ax1.set_xlim([self.min - space - 0.5, upper_limit +
                 space + 0.5])
 
         # plot shaded values
@@ -254,17 +1875,83 @@ class Coverage(object):
             plt.savefig(out_img, bbox_inches='tight')
 
 
-if __name__ == '__main__':
+# figure reused by all plots of a plot worker process
+_worker_figure = None
+
+
+def _init_plot_worker():
+    """Creates the figure of a plot worker process."""
+    global _worker_figure
+    _worker_figure = plt.figure(figsize=(8, 8))
+
+
+def _plot_histogram(args):
+    """Plots a coverage histogram in the figure of the worker process, for use
+    in a process pool."""
+    values, counts, plot_kwargs = args
+    counter = collections.Counter(dict(zip(values, counts)))
+    Coverage.from_counter(counter).plot(figure=_worker_figure, **plot_kwargs)
 
-    usage = __doc__.split('\n\n\n')
-    parser = argparse.ArgumentParser(
-            formatter_class=argparse.RawDescriptionHelpFormatter,
-            description=usage[0], epilog=usage[1])
 
-    parser.add_argument('input', type=str, help='Path to input file '
-            '(coverageBed output) or \'-\' for stdin')
+def plot_histograms(hists, out_dir, processes=1, title=None, **plot_kwargs):
+    """Plots the coverage histogram of each name in a process pool.
+
+    Each worker process creates a single figure, which is cleared and reused
+    for all its plots.
+
+    :param hists: coverage histogram per name
+    :type hists: Histograms
+    :param out_dir: directory to write a PNG file per name to
+    :type out_dir: str
+    :param processes: number of processes to use
+    :type processes: int
+    :param title: plot title lines, to which the name is added
+    :type title: list of str
+    :returns: path of the plot of each name
+    :rtype: dict of str
+
+    """
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    paths, tasks = {}, []
+    for name, hist in hists.items():
+        values = np.flatnonzero(hist)
+        # path separators are not allowed in file names
+        paths[name] = os.path.join(out_dir,
+                name.replace(os.sep, '_') + '.png')
+        tasks.append((values.tolist(), hist[values].tolist(),
+            dict(plot_kwargs, title=list(title or []) + [name],
+                out_img=paths[name])))
+    pool = multiprocessing.Pool(processes, _init_plot_worker)
+    try:
+        # one task at a time, as plots of large chromosomes take longer
+        pool.map(_plot_histogram, tasks, chunksize=1)
+    finally:
+        pool.terminate()
+    return paths
+
+
+def add_report_arguments(parser):
+    """Adds the arguments of the statistics and plot output to a parser."""
+    parser.add_argument('--thresholds', dest='thresholds', type=str,
+            default=','.join(map(str, THRESHOLDS)),
+            help='Comma-separated coverage values for which the fraction of '
+            'bases covered at least that many times is reported')
+    parser.add_argument('--contig-stats', dest='contig_stats', type=str,
+            help='Path to output file of the statistics of each chromosome, '
+            'instead of including them in the JSON output (which is written '
+            'to stdout); recommended for assemblies with many contigs')
+    parser.add_argument('--contig-stats-format', dest='contig_stats_fmt',
+            type=str, choices=['tsv', 'ndjson'], default='tsv',
+            help='Format of the per-chromosome statistics: tab-separated '
+            'columns or one JSON object per line')
+    parser.add_argument('--histograms-out', dest='histograms_out', type=str,
+            help='Path to output JSON file of the coverage histograms, which '
+            'can be summed with the merge command')
     parser.add_argument('--plot', dest='plot', type=str,
             help='Path to output PNG file')
+    parser.add_argument('--plot-per-chrom', dest='plot_per_chrom', type=str,
+            help='Path to output directory of a PNG file per chromosome')
     parser.add_argument('--min-cov-show', dest='min_cov_ok', type=int,
             default=6, help='Minimum coverage to show in bar graph')
     parser.add_argument('--max-percentile-show', dest='max_pct_show', type=int,
@@ -272,52 +1959,214 @@ if __name__ == '__main__':
     parser.add_argument('--title', dest='title', type=str,
             default='Coverage Plot', help='Plot title')
     parser.add_argument('--subtitle', dest='subtitle', type=str, help='Plot subtitle')
+    parser.add_argument('--processes', '--threads', dest='processes', type=int,
+            default=1, help='Number of processes used to parse per-base or '
+            'bedGraph input files, and to plot per chromosome')
 
-    args = parser.parse_args()
 
-    if args.input == '-':
-        instream = sys.stdin
+if __name__ == '__main__':
+
+    usage = __doc__.split('\n\n\n')
+    if sys.argv[1:2] == ['merge']:
+        parser = argparse.ArgumentParser(
+                prog='%s merge' % os.path.basename(sys.argv[0]),
+                description='Sum coverage histograms saved with '
+                '--histograms-out into final statistics and plot; the inputs '
+                'must cover disjoint chromosomes and regions')
+        parser.add_argument('inputs', type=str, nargs='+',
+                help='Paths to coverage histogram files')
+        add_report_arguments(parser)
+        args = parser.parse_args(sys.argv[2:])
+        input_label = ', '.join(args.inputs)
     else:
-        instream = open(args.input, 'r')
+        parser = argparse.ArgumentParser(
+                formatter_class=argparse.RawDescriptionHelpFormatter,
+                description=usage[0], epilog=usage[1])
+        parser.add_argument('input', type=str, help='Path to input file '
+                '(coverageBed output or BAM file) or \'-\' for stdin')
+        parser.add_argument('--format', dest='fmt', type=str,
+                choices=['auto', 'bam'] + sorted(PARSERS), default='auto',
+                help='Input format: per-base coverage (coverageBed -d), '
+                'bedGraph (genomecov -bga), histogram (coverageBed -hist) or '
+                'an indexed BAM file; detected from the start of the input '
+                'by default')
+        parser.add_argument('--targets', dest='targets', type=str,
+                help='Path to BED file of target regions, for BAM input')
+        parser.add_argument('--regions', dest='regions', type=str,
+                help='Path to BED file of regions to report statistics for, '
+                'per region name (4th column)')
+        parser.add_argument('--windows-out', dest='windows_out', type=str,
+                help='Path to output bedGraph file of the mean coverage in '
+                'fixed-size windows')
+        parser.add_argument('--windows-covered-out',
+                dest='windows_covered_out', type=str,
+                help='Path to output bedGraph file of the fraction of bases '
+                'with nonzero coverage in fixed-size windows')
+        parser.add_argument('--window-size', dest='window_size', type=int,
+                default=WINDOW_SIZE, help='Number of bases per window of the '
+                'windowed coverage outputs')
+        parser.add_argument('--cache', dest='cache', type=str,
+                help='Path to a directory caching the per-base coverage of '
+                'the input; built on the first run, and read instead of the '
+                'input while the input is unchanged')
+        add_report_arguments(parser)
+        args = parser.parse_args()
+        args.inputs = None
+        input_label = args.input
+
+    if args.processes < 1:
+        parser.error("Number of processes must be at least 1")
+    if args.contig_stats == '-':
+        parser.error("Per-chromosome statistics can not be written to stdout, "
+                "which receives the JSON output")
+    try:
+        thresholds = sorted(set(int(x) for x in args.thresholds.split(',')))
+    except ValueError:
+        parser.error("Invalid coverage thresholds: %r" % args.thresholds)
 
     title = [args.title]
     if args.subtitle is None:
-        title.append("'" + args.input + "'")
+        title.append("'" + input_label + "'")
     else:
         title.append(args.subtitle)
 
-    coverages = {}
-    all_covs, cur_covs = [], []
-    cur_chrom, prev_chrom = None, None
-    for line in (l.strip() for l in instream):
-        cols = line.split('\t')
-        cur_chrom = cols[0]
-        cvg = int(cols[-1])
-        # coverage for all positions
-        all_covs.append(cvg)
-        # coverage per chromosome
-        if cur_chrom != prev_chrom:
-            if prev_chrom is not None:
-                coverages[prev_chrom] = cur_covs
-            cur_covs = []
-            prev_chrom = cur_chrom
-        cur_covs.append(cvg)
-    # also append the last chromosome from the file
-    coverages[cur_chrom] = cur_covs
-
-    coverages['_all'] = all_covs
-
-    for cname, clist in coverages.items():
-        coverages[cname] = Coverage(clist)
-
-    if args.input != '-':
-        instream.close()
+    region_hists = None
+    if args.inputs is not None:
+        hists_list, region_hists_list = [], []
+        # input file of each chromosome and region name
+        chrom_sources, region_sources = {}, {}
+        for path in args.inputs:
+            try:
+                hists, file_region_hists = load_histograms(path)
+            except (IOError, ValueError) as e:
+                parser.error(str(e))
+            hists_list.append(hists)
+            for name in hists.names:
+                if name in chrom_sources:
+                    parser.error("Coverage of chromosome %r is in both %r and "
+                            "%r; only inputs covering disjoint positions can "
+                            "be merged" % (name, chrom_sources[name], path))
+                chrom_sources[name] = path
+            if file_region_hists is not None:
+                region_hists_list.append(file_region_hists)
+                for name in file_region_hists.names:
+                    if name in region_sources:
+                        warnings.warn("Coverage of region %r is in both %r "
+                                "and %r; its statistics are only valid if "
+                                "the inputs cover disjoint positions" %
+                                (name, region_sources[name], path))
+                    region_sources[name] = path
+        hists = merge_histograms(hists_list)
+        if region_hists_list:
+            region_hists = merge_histograms(region_hists_list)
+        if not hists.total().any():
+            parser.error("No coverage in histogram files")
+
+    else:
+        if args.processes > 1 and args.input == '-':
+            parser.error("Multiple processes can not be used with stdin input")
+        if args.cache is not None and args.input == '-':
+            parser.error("The coverage cache can not be used with stdin input")
+
+        if args.input == '-':
+            instream = io.open(sys.stdin.fileno(), 'rb', closefd=False)
+        else:
+            instream = io.open(args.input, 'rb')
+        fmt = args.fmt
+        if fmt == 'auto':
+            try:
+                fmt, instream = detect_format(instream)
+            except ValueError as e:
+                parser.error(str(e))
+        if fmt == 'bam':
+            if args.input == '-':
+                parser.error("BAM input must be an indexed file, not stdin")
+            if args.targets is None:
+                parser.error("BAM input requires a target BED file "
+                        "(--targets)")
+            if pysam is None:
+                parser.error("BAM input requires the pysam package")
+
+        if fmt not in ('depth', 'bam'):
+            if args.cache is not None:
+                parser.error("The coverage cache requires per-base "
+                        "(coverageBed -d) or BAM input")
+            if args.regions is not None:
+                parser.error("Per-region statistics require per-base "
+                        "(coverageBed -d) or BAM input")
+            if args.windows_out is not None or \
+                    args.windows_covered_out is not None:
+                parser.error("Windowed coverage requires per-base "
+                        "(coverageBed -d) or BAM input")
+        if args.window_size < 1:
+            parser.error("Window size must be at least 1")
+
+        collectors = []
+        if args.regions is not None:
+            region_coverage = RegionCoverage(
+                    RegionIndex.from_bed(args.regions))
+            collectors.append(region_coverage)
+        if args.windows_out is not None or \
+                args.windows_covered_out is not None:
+            window_coverage = WindowCoverage(args.window_size)
+            collectors.append(window_coverage)
+
+        cache = None
+        if args.cache is not None:
+            stat = os.stat(args.input)
+            source = {'path': os.path.abspath(args.input), 'format': fmt,
+                    'size': stat.st_size, 'mtime': stat.st_mtime,
+                    'targets': args.targets and os.path.abspath(args.targets)}
+            cache = CoverageCache.load(args.cache, source)
+            if cache is None:
+                new_cache = CoverageCache(args.cache)
+                collectors.append(new_cache)
+
+        if cache is not None:
+            instream.close()
+            hists = cache.parse(collectors)
+        elif fmt == 'bam':
+            instream.close()
+            hists = parse_bam(args.input, args.targets, collectors)
+        # run-length histograms are small enough to parse in a single process
+        elif args.processes > 1 and fmt != 'hist':
+            instream.close()
+            hists = parse_parallel(args.input, fmt, args.processes, collectors)
+        else:
+            hists = PARSERS[fmt](instream, collectors=collectors)
+            instream.close()
+        if args.cache is not None and cache is None:
+            new_cache.commit(source)
+        if args.regions is not None:
+            region_hists = region_coverage.hists
+        if args.windows_out is not None:
+            window_coverage.write_bedgraph(args.windows_out)
+        if args.windows_covered_out is not None:
+            window_coverage.write_bedgraph(args.windows_covered_out,
+                    covered=True)
+
+    if args.histograms_out is not None:
+        dump_histograms(args.histograms_out, hists, region_hists)
+    # the genome-wide histogram is the sum of the per-chromosome histograms
+    coverages = {'_all': Coverage.from_counter(
+        histogram_to_counter(hists.total()))}
+    if args.contig_stats is not None:
+        write_stats_table(args.contig_stats, *hists.quick_stats(thresholds),
+                fmt=args.contig_stats_fmt)
+    else:
+        for cname, hist in hists.items():
+            coverages[cname] = Coverage.from_counter(
+                    histogram_to_counter(hist))
 
     if args.plot is not None:
         coverages['_all'].plot(min_cov_ok=args.min_cov_ok, percentile_show=args.max_pct_show,
                 title=title, out_img=args.plot)
 
-    stats = {'coverage': {k: v.get_quick_stats() for k, v in coverages.items()}}
+    stats = {'coverage': {k: v.get_quick_stats(thresholds)
+        for k, v in coverages.items()}}
+    if region_hists is not None:
+        stats['regions'] = {k: Coverage.from_counter(histogram_to_counter(v))
+                .get_quick_stats(thresholds) for k, v in region_hists.items()}
     if args.plot is not None:
         files = {'plot_coverage': {
             'path': os.path.abspath(args.plot),
@@ -326,6 +2175,15 @@ if __name__ == '__main__':
         }
     else:
         files = {}
+    if args.plot_per_chrom is not None:
+        paths = plot_histograms(hists, args.plot_per_chrom, args.processes,
+                title=title, min_cov_ok=args.min_cov_ok,
+                percentile_show=args.max_pct_show)
+        for name, path in paths.items():
+            files['plot_coverage_' + name] = {
+                'path': os.path.abspath(path),
+                'checksum_sha1': None,
+            }
 
     json.dump({'stats': stats, 'files': files}, sys.stdout, sort_keys=True, indent=4,
             separators=(',', ': '))
\ No newline at end of file
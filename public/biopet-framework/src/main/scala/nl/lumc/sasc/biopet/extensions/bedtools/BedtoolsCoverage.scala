@@ -34,6 +34,9 @@ class BedtoolsCoverage(val root: Configurable) extends Bedtools {
   @Argument(doc = "depth", required = false)
   var depth: Boolean = false
 
+  @Argument(doc = "histogram", required = false)
+  var histogram: Boolean = false
+
   @Argument(doc = "sameStrand", required = false)
   var sameStrand: Boolean = false
 
@@ -53,6 +56,7 @@ class BedtoolsCoverage(val root: Configurable) extends Bedtools {
     required(inputTag, input) +
     required("-b", intersectFile) +
     conditional(depth, "-d") +
+    conditional(histogram, "-hist") +
     conditional(sameStrand, "-s") +
     conditional(diffStrand, "-S") +
     " > " + required(output)
@@ -61,12 +65,14 @@ class BedtoolsCoverage(val root: Configurable) extends Bedtools {
 object BedtoolsCoverage {
   /** Returns defaul bedtools coverage */
   def apply(root: Configurable, input: File, intersect: File, output: File,
-            depth: Boolean = true, sameStrand: Boolean = false, diffStrand: Boolean = false): BedtoolsCoverage = {
+            depth: Boolean = true, sameStrand: Boolean = false, diffStrand: Boolean = false,
+            histogram: Boolean = false): BedtoolsCoverage = {
     val bedtoolsCoverage = new BedtoolsCoverage(root)
     bedtoolsCoverage.input = input
     bedtoolsCoverage.intersectFile = intersect
     bedtoolsCoverage.output = output
     bedtoolsCoverage.depth = depth
+    bedtoolsCoverage.histogram = histogram
     bedtoolsCoverage.sameStrand = sameStrand
     bedtoolsCoverage.diffStrand = diffStrand
     bedtoolsCoverage
@@ -33,10 +33,16 @@ class CoverageStats(val root: Configurable) extends PythonCommandLineFunction wi
   @Output(doc = "plot File (png)")
   var plot: File = _
 
-  override val defaultCoreMemory = 9.0
+  /** Coverage values to report the fraction of bases covered at least that many times for */
+  var thresholds: List[String] = config("thresholds", default = Nil)
+
+  override val defaultCoreMemory = 2.0
 
   def cmdLine = getPythonCommand +
-    required(input) + required("--plot", plot) + " > " + required(output)
+    required(input) + required("--plot", plot) +
+    optional("--processes", nCoresRequest) +
+    (if (thresholds.nonEmpty) required("--thresholds", thresholds.mkString(",")) else "") +
+    " > " + required(output)
 
   def summaryFiles: Map[String, File] = Map("output" -> output, "plot" -> plot)
 
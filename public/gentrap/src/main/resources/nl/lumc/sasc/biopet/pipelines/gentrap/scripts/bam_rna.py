@@ -25,10 +25,17 @@
 # (c) 2013 Wibowo Arindrarto [SASC - LUMC]
 
 import argparse
+import cPickle as pickle
 import json
 import locale
+import multiprocessing
 import os
-from collections import OrderedDict
+import random
+import shutil
+import tempfile
+import time
+from array import array
+from collections import Counter, namedtuple, OrderedDict
 from functools import partial
 
 import pysam
@@ -47,15 +54,8 @@ func_nunmap = lambda rec: (rec.flag & 0x4) and (rec.flag & 0x8)
 func_nmap_pair = lambda rec: not rec.flag & 0xC
 # -f 0x2
 func_nmap_pair_ok = lambda rec: rec.flag & 0x2
-# mapped to different chromosomes / reference sequences
-func_nmap_diffchr = lambda rec: rec.rnext != rec.tid
 # -F 0x4 -f 0x8
 func_nmap_sgltn = lambda rec: (not rec.flag & 0x4) and (rec.flag & 0x8)
-# check if spliced
-func_splice = lambda rec: 'N' in rec.cigarstring
-# check if pass QC
-# not bool since we always need to run each read through it
-func_qc = lambda rec: 1 if rec.flag & 0x200 else 0
 
 FLAGS = OrderedDict((
     ('total', 'Total'),
@@ -71,23 +71,870 @@ FLAGS = OrderedDict((
     ('spliceSingleton', 'Split reads, singletons'),
 ))
 
+# bit of each count in the category mask of a record
+BITS = OrderedDict((flag, 1 << idx) for idx, flag in enumerate(FLAGS))
+# number of distinct category masks; a mask is tagged with a group (see
+# ``Groups``) by adding ``code * N_MASKS``, with code 0 for all records
+N_MASKS = 1 << len(BITS)
+# number of distinct SAM flag values
+N_SAM_FLAGS = 4096
+
+# number of (name hash, mask) pairs buffered per partition before writing
+PARTITION_BUFFER_SIZE = 1 << 16
+# number of shards (regions of about equal total length) per process when
+# counting in multiple processes
+SHARDS_PER_PROCESS = 4
+# default number of seconds between checkpoints, and number of records
+# between checks whether a checkpoint is due
+CHECKPOINT_INTERVAL = 600
+CHECKPOINT_RECORDS = 1 << 16
+
+# record with only a flag, to classify flag values with the functions above
+_FlagRecord = namedtuple('_FlagRecord', ['flag'])
+
+
+def classify_flag(flag):
+    """Returns the categories a record with the given SAM flag is counted
+    in, as masks of category bits.
+
+    :param flag: SAM flag
+    :type flag: int
+    :returns: mask of categories counted for every record with the flag,
+        mask of categories additionally counted if the record is spliced,
+        and whether the record is counted as mapped to different
+        chromosomes (and MAPQ >= 5) if its mate is on another reference
+    :rtype: tuple of (int, int, bool)
+
+    """
+    rec = _FlagRecord(flag)
+    mask = BITS['total']
+    splice_mask = BITS['totalSplice']
+    diffchr = False
+    if func_nunmap(rec):
+        mask |= BITS['unmapped']
+    elif func_nmap(rec):
+        mask |= BITS['mapped']
+        if func_nmap_pair(rec):
+            mask |= BITS['mappedPair']
+            if func_nmap_pair_ok(rec):
+                mask |= BITS['mappedPairProper']
+                splice_mask |= BITS['splicePairProper']
+            else:
+                diffchr = True
+        elif func_nmap_sgltn(rec):
+            mask |= BITS['singleton']
+            splice_mask |= BITS['spliceSingleton']
+    return mask, splice_mask, diffchr
+
+# category masks of all SAM flag values, see ``classify_flag``
+FLAG_MASKS, FLAG_SPLICE_MASKS, FLAG_DIFFCHR = [list(x) for x in
+        zip(*[classify_flag(flag) for flag in range(N_SAM_FLAGS)])]
+DIFFCHR_MASK = BITS['mappedDiffChr']
+DIFFCHR_Q_MASK = BITS['mappedDiffChr'] | BITS['mappedDiffChrQ']
+
+
+def record_mask(rec):
+    """Returns the mask of the categories a record is counted in."""
+    flag = rec.flag & (N_SAM_FLAGS - 1)
+    mask = FLAG_MASKS[flag]
+    cigar = rec.cigarstring
+    if cigar is not None and 'N' in cigar:
+        mask |= FLAG_SPLICE_MASKS[flag]
+    if FLAG_DIFFCHR[flag] and rec.rnext != rec.tid:
+        mask |= DIFFCHR_Q_MASK if rec.mapq >= 5 else DIFFCHR_MASK
+    return mask
+
+
+def mate_mask(rec):
+    """Returns the mask of the categories the primary alignment of the mate
+    of a paired record is counted in, derived from the mate flags of the
+    record and its mate CIGAR (MC) and mate MAPQ (MQ) tags.
+
+    Raises ValueError if the mate is mapped and the record has no MC tag,
+    or if the mate is on another reference and the record has no MQ tag, as
+    the mate categories would be incomplete.
+
+    """
+    flag = rec.flag & (N_SAM_FLAGS - 1)
+    # swap the unmapped (0x4) and mate unmapped (0x8) flags
+    flag = (flag & ~0xC) | ((flag & 0x4) << 1) | ((flag & 0x8) >> 1)
+    mask = FLAG_MASKS[flag]
+    if not flag & 0x4:
+        try:
+            mate_cigar = rec.opt('MC')
+        except KeyError:
+            raise ValueError("Record %r has no mate CIGAR (MC) tag, which "
+                    "is required to count primary reads; it can be added "
+                    "with e.g. Picard FixMateInformation" % rec.qname)
+        if 'N' in mate_cigar:
+            mask |= FLAG_SPLICE_MASKS[flag]
+    if FLAG_DIFFCHR[flag] and rec.rnext != rec.tid:
+        try:
+            mate_mapq = rec.opt('MQ')
+        except KeyError:
+            raise ValueError("Record %r has no mate MAPQ (MQ) tag, which "
+                    "is required to count primary reads; it can be added "
+                    "with e.g. Picard FixMateInformation" % rec.qname)
+        mask |= DIFFCHR_Q_MASK if mate_mapq >= 5 else DIFFCHR_MASK
+    return mask
+
+
+class PartitionWriter(object):
+
+    """Class writing (read name hash, category mask) pairs to partition
+    files, chosen by name hash, so all records of a read are written to the
+    same partition."""
+
+    def __init__(self, paths, sizes=None):
+        """
+
+        :param paths: paths of the partition files
+        :type paths: list of str
+        :param sizes: sizes to truncate existing partition files to and
+            append to, when resuming from a checkpoint
+        :type sizes: list of int
+
+        """
+        self.paths = paths
+        if sizes is None:
+            self._handles = [open(path, 'wb') for path in paths]
+        else:
+            self._handles = [open(path, 'r+b') for path in paths]
+            for handle, size in zip(self._handles, sizes):
+                handle.truncate(size)
+                handle.seek(size)
+        self._buffers = [array('l') for _ in paths]
+
+    def add(self, hname, mask):
+        """Adds the category mask of a record with the given name hash."""
+        idx = hname % len(self._buffers)
+        buf = self._buffers[idx]
+        buf.append(hname)
+        buf.append(mask)
+        if len(buf) >= 2 * PARTITION_BUFFER_SIZE:
+            buf.tofile(self._handles[idx])
+            self._buffers[idx] = array('l')
+
+    def flush(self):
+        """Writes the buffered pairs to disk and returns the sizes of the
+        partition files."""
+        for idx, handle in enumerate(self._handles):
+            self._buffers[idx].tofile(handle)
+            self._buffers[idx] = array('l')
+            handle.flush()
+            os.fsync(handle.fileno())
+        return [handle.tell() for handle in self._handles]
+
+    def close(self):
+        """Writes the buffered pairs and closes the partition files."""
+        for buf, handle in zip(self._buffers, self._handles):
+            buf.tofile(handle)
+            handle.close()
+        self._buffers = []
+
+
+def reduce_partition(paths):
+    """Counts the reads in the files of a partition of (name hash, category
+    mask) pairs, combining the masks of the pairs of each name hash.
+
+    :param paths: paths to the files of the partition
+    :type paths: list of str
+    :returns: number of reads of each (tagged) mask
+    :rtype: collections.Counter
+
+    """
+    read_masks = {}
+    for path in paths:
+        # hashes are C longs, like the array items
+        pairs = array('l')
+        with open(path, 'rb') as handle:
+            pairs.fromstring(handle.read())
+        for idx in xrange(0, len(pairs), 2):
+            hname = pairs[idx]
+            read_masks[hname] = read_masks.get(hname, 0) | pairs[idx + 1]
+        del pairs
+    return count_read_masks(read_masks)
+
+
+def count_read_masks(read_masks):
+    """Counts the reads of each category mask.
+
+    :param read_masks: (tagged) category mask of each read, by name hash
+    :type read_masks: dict
+    :returns: number of reads of each (tagged) mask
+    :rtype: collections.Counter
+
+    """
+    return Counter(read_masks.itervalues())
+
+
+class Checkpoint(object):
+
+    """Class saving the counting state of a BAM file periodically, with the
+    BGZF virtual offset of the next record to count, so an interrupted run
+    can seek to it and continue.
+
+    The state is saved as a pickle, replaced atomically. Partition files
+    are kept in a work directory next to it, until the run finishes.
+
+    """
+
+    def __init__(self, path, key, interval=CHECKPOINT_INTERVAL):
+        """
+
+        :param path: path of the checkpoint file
+        :type path: str
+        :param key: identification of the BAM file and counting options,
+            which a saved checkpoint must match to be resumed from
+        :type key: tuple
+        :param interval: minimal number of seconds between checkpoints
+        :type interval: int
+
+        """
+        self.path = path
+        self.key = key
+        self.interval = interval
+        self.work_dir = path + '.parts'
+        # saved state, and offset of the next record to count
+        self.state, self.offset = None, None
+        if os.path.exists(path):
+            with open(path, 'rb') as handle:
+                saved = pickle.load(handle)
+            if saved['key'] != key:
+                raise ValueError("Checkpoint %r does not match the BAM file "
+                        "or counting options" % path)
+            self.state, self.offset = saved['state'], saved['offset']
+        self._saved_at = time.time()
+
+    def due(self):
+        """Returns whether the interval since the last checkpoint passed."""
+        return time.time() - self._saved_at >= self.interval
+
+    def save(self, offset, state):
+        """Saves the counting state.
+
+        :param offset: virtual offset of the next record to count
+        :type offset: int
+        :param state: counters and other objects to resume counting with
+        :type state: dict
+
+        """
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as handle:
+            pickle.dump({'key': self.key, 'offset': offset, 'state': state},
+                    handle, pickle.HIGHEST_PROTOCOL)
+            handle.flush()
+            os.fsync(handle.fileno())
+        os.rename(tmp_path, self.path)
+        self._saved_at = time.time()
+
+    def remove(self):
+        """Removes the checkpoint and its work directory."""
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+
+def count_records(records, suflen=0, primary_reads=False, partitions=None,
+        groups=None, collectors=(), checkpoint=None):
+    """Counts the category masks of alignment records and their reads.
+
+    :param records: alignment records
+    :type records: iterable
+    :param suflen: length of read pair suffix, if present
+    :type suflen: int
+    :param primary_reads: whether to count reads from their primary
+        alignments (see ``BarnStat._count_unsorted``) instead of their names
+    :type primary_reads: bool
+    :param partitions: paths of partition files to write read name hashes
+        to, instead of keeping them in memory
+    :type partitions: list of str
+    :param groups: groups to also count the records and reads of, with
+        masks tagged by group code
+    :type groups: Groups
+    :param collectors: objects that also collect statistics from each
+        record, through their ``add`` method (see ``COLLECTORS``)
+    :type collectors: list
+    :param checkpoint: checkpoint to resume counting from, if it has a
+        saved state, and to save the counting state to periodically;
+        ``records`` must be the BAM file
+    :type checkpoint: Checkpoint
+    :returns: number of alignments and QC-failed alignments of each tagged
+        mask, and either the number of reads of each tagged mask (primary
+        reads), the tagged mask of each read by name hash, or None
+        (partitions)
+    :rtype: tuple of (Counter, Counter, Counter or dict or None)
+
+    """
+    alns, alns_qc = [0] * N_MASKS, [0] * N_MASKS
+    group_alns, group_alns_qc = Counter(), Counter()
+    reads = [0] * N_MASKS if primary_reads else {}
+    group_reads = Counter()
+    sizes = None
+    if checkpoint is not None and checkpoint.state is not None:
+        state = checkpoint.state
+        alns, alns_qc = state['alns'], state['alns_qc']
+        group_alns, group_alns_qc = state['group_alns'], state['group_alns_qc']
+        reads, group_reads = state['reads'], state['group_reads']
+        sizes = state['partitions']
+        # collectors are empty, so merging restores their saved state
+        for collector, saved in zip(collectors, state['collectors']):
+            collector.merge(saved)
+        records.seek(checkpoint.offset)
+    writer = PartitionWriter(partitions, sizes) if partitions else None
+    n_left = CHECKPOINT_RECORDS
+    tags = ()
+    # index for suffix removal, if suffix exist (> 0)
+    if suflen:
+        sufslice = slice(-suflen)
+    else:
+        sufslice = slice(None)
+
+    for rec in records:
+        mask = record_mask(rec)
+        alns[mask] += 1
+        if rec.flag & 0x200:
+            alns_qc[mask] += 1
+        for collector in collectors:
+            collector.add(rec)
+        if groups is not None:
+            tags = groups.tags(rec)
+            for tag, _ in tags:
+                group_alns[mask + tag] += 1
+                if rec.flag & 0x200:
+                    group_alns_qc[mask + tag] += 1
+        if primary_reads:
+            # skip secondary and supplementary alignments and second reads
+            if not (rec.flag & 0x900 or (rec.flag & 0x1 and
+                    not rec.flag & 0x40)):
+                if rec.flag & 0x1:
+                    mask |= mate_mask(rec)
+                reads[mask] += 1
+                for tag, _ in tags:
+                    group_reads[mask + tag] += 1
+        else:
+            # remove '/1' or '/2' suffixes, to collapse read pair counts
+            hname = hash(rec.qname[sufslice])
+            if writer is None:
+                reads[hname] = reads.get(hname, 0) | mask
+            else:
+                writer.add(hname, mask)
+            # the reads of a group are tracked by salted name hash
+            for tag, salt in tags:
+                gname = hname ^ salt
+                if writer is None:
+                    reads[gname] = reads.get(gname, 0) | (mask + tag)
+                else:
+                    writer.add(gname, mask + tag)
+        if checkpoint is not None:
+            n_left -= 1
+            if not n_left:
+                n_left = CHECKPOINT_RECORDS
+                if checkpoint.due():
+                    checkpoint.save(records.tell(), {'alns': alns,
+                        'alns_qc': alns_qc, 'group_alns': group_alns,
+                        'group_alns_qc': group_alns_qc, 'reads': reads,
+                        'group_reads': group_reads, 'collectors': collectors,
+                        'partitions': writer.flush() if writer else None})
+
+    if writer is not None:
+        writer.close()
+        reads = None
+    elif primary_reads:
+        group_reads.update(dict(enumerate(reads)))
+        reads = group_reads
+    group_alns.update(dict(enumerate(alns)))
+    group_alns_qc.update(dict(enumerate(alns_qc)))
+    return group_alns, group_alns_qc, reads
+
+
+def open_bam(path):
+    """Opens a BAM file, or SAM or BAM from stdin if the path is '-'."""
+    if path == '-':
+        # the format of stdin is detected by htslib
+        return pysam.Samfile('-', 'r')
+    return pysam.Samfile(path, 'rb')
+
+
+class Groups(object):
+
+    """Class assigning records to groups, for counts per reference sequence
+    and/or per read group next to the counts of all records.
+
+    Group codes are derived from the BAM header only, so they are the same
+    in all processes reading the same BAM file.
+
+    """
+
+    # breakdowns of the counts, in code order
+    kinds = ('references', 'readGroups')
+
+    def __init__(self, bam, by_reference=False, by_read_group=False):
+        """
+
+        :param bam: BAM file
+        :type bam: pysam.Samfile
+        :param by_reference: whether to count per reference sequence
+        :type by_reference: bool
+        :param by_read_group: whether to count per read group
+        :type by_read_group: bool
+
+        """
+        self.by_reference = by_reference
+        self.by_read_group = by_read_group
+        # '*' for records without a reference sequence or a known read group
+        self.names = (['*'] + list(bam.references),
+                ['*'] + [rg['ID'] for rg in bam.header.get('RG', [])])
+        self._rg_idx = dict((rg, idx) for idx, rg in
+                enumerate(self.names[1]) if idx)
+        # tag and name hash salt of each group, by reference (or read group)
+        # index. Salts are random, since the hashes of tuples or strings of
+        # similar names (e.g. numbered read names) differ in few bits and
+        # collide when combined with similar codes.
+        rand = random.Random(0)
+        self._tags = [[(self.code(kind, idx) * N_MASKS, rand.getrandbits(63))
+            for idx in range(len(names))]
+            for kind, names in enumerate(self.names)]
+
+    def tags(self, rec):
+        """Returns the tag and name hash salt of each group of a record."""
+        tags = []
+        if self.by_reference:
+            tags.append(self._tags[0][rec.tid + 1])
+        if self.by_read_group:
+            try:
+                rg_idx = self._rg_idx.get(rec.opt('RG'), 0)
+            except KeyError:
+                rg_idx = 0
+            tags.append(self._tags[1][rg_idx])
+        return tags
+
+    @staticmethod
+    def code(kind, idx):
+        """Returns the code of a group, by breakdown and name index."""
+        return 1 + kind + 2 * idx
+
+    def group(self, code):
+        """Returns the breakdown and the group name of a group code."""
+        kind, idx = (code - 1) % 2, (code - 1) // 2
+        return self.kinds[kind], self.names[kind][idx]
+
+
+class ContigCounts(object):
+
+    """Class counting the mapped alignments of each reference sequence, as
+    ``samtools view -c -F 0x4`` does per region."""
+
+    key = 'contigs'
+
+    def __init__(self):
+        # by reference index
+        self.counts = {}
+
+    def add(self, rec):
+        """Counts a record, if it is mapped."""
+        if not rec.flag & 0x4:
+            self.counts[rec.tid] = self.counts.get(rec.tid, 0) + 1
+
+    def merge(self, other):
+        """Adds the counts of another contig collector."""
+        for tid, count in other.counts.iteritems():
+            self.counts[tid] = self.counts.get(tid, 0) + count
+
+    def result(self, references):
+        """Returns the count of each reference sequence, by name."""
+        return OrderedDict((ref, self.counts.get(tid, 0))
+                for tid, ref in enumerate(references))
+
+
+class InsertSizeHistogram(object):
+
+    """Class collecting the insert size histogram of read pairs per pair
+    orientation, with the read pairs selected as Picard
+    CollectInsertSizeMetrics does: one record per pair (the second read), of
+    primary, non-duplicate alignments with both reads mapped and a non-zero
+    template length."""
+
+    key = 'insertSize'
+
+    # flags that must be set (0x1) or unset, see the class description
+    FLAG_FILTER = 0x1 | 0x4 | 0x8 | 0x40 | 0x100 | 0x400 | 0x800
+
+    def __init__(self):
+        # insert size counts by pair orientation
+        self.hists = {}
+
+    def add(self, rec):
+        """Counts the insert size of a record, if it is selected."""
+        if rec.flag & self.FLAG_FILTER != 0x1 or not rec.tlen:
+            return
+        orientation = self.orientation(rec)
+        hist = self.hists.get(orientation)
+        if hist is None:
+            hist = self.hists[orientation] = {}
+        size = abs(rec.tlen)
+        hist[size] = hist.get(size, 0) + 1
+
+    @staticmethod
+    def orientation(rec):
+        """Returns the pair orientation of a record, as Picard does."""
+        reverse = rec.flag & 0x10
+        if bool(reverse) == bool(rec.flag & 0x20):
+            return 'TANDEM'
+        # 5' ends of the reads on the positive and negative strands,
+        # 1-based
+        if reverse:
+            positive, negative = rec.mpos + 1, rec.aend
+        else:
+            positive, negative = rec.pos + 1, rec.pos + 1 + rec.tlen
+        return 'FR' if positive < negative else 'RF'
+
+    def merge(self, other):
+        """Adds the histograms of another insert size collector."""
+        for orientation, other_hist in other.hists.iteritems():
+            hist = self.hists.setdefault(orientation, {})
+            for size, count in other_hist.iteritems():
+                hist[size] = hist.get(size, 0) + count
+
+    def result(self, references):
+        """Returns the number of pairs, median and mean insert size and the
+        histogram of each pair orientation."""
+        result = OrderedDict()
+        for orientation in sorted(self.hists):
+            hist = sorted(self.hists[orientation].items())
+            n_pairs = sum(count for _, count in hist)
+            # lower median, as Picard
+            cum = 0
+            for median, count in hist:
+                cum += count
+                if 2 * cum >= n_pairs:
+                    break
+            result[orientation] = OrderedDict((
+                ('pairs', n_pairs),
+                ('median', median),
+                ('mean', float(sum(size * count for size, count in hist)) /
+                    n_pairs),
+                ('histogram', [list(item) for item in hist]),
+            ))
+        return result
+
+
+class MapqHistogram(object):
+
+    """Class collecting the MAPQ histogram of mapped alignments."""
+
+    key = 'mapq'
+
+    def __init__(self):
+        self.counts = [0] * 256
+
+    def add(self, rec):
+        """Counts the MAPQ of a record, if it is mapped."""
+        if not rec.flag & 0x4:
+            self.counts[rec.mapq] += 1
+
+    def merge(self, other):
+        """Adds the histogram of another MAPQ collector."""
+        self.counts = [x + y for x, y in zip(self.counts, other.counts)]
+
+    def result(self, references):
+        """Returns the number of alignments of each MAPQ, up to the highest
+        MAPQ."""
+        counts = self.counts
+        while counts and not counts[-1]:
+            counts = counts[:-1]
+        return counts
+
+
+class SpliceCounts(object):
+
+    """Class counting spliced alignments and their splice junctions (N
+    operations)."""
+
+    key = 'splice'
+
+    def __init__(self):
+        # spliced alignments by number of junctions, split by primary
+        self.counts = {}
+
+    def add(self, rec):
+        """Counts the junctions of a record, if it is spliced."""
+        # CIGAR tuples are much cheaper to get from pysam than the string
+        cigar = rec.cigartuples
+        if cigar is None or len(cigar) < 3:
+            return
+        n_junctions = 0
+        for op, _ in cigar:
+            if op == 3:
+                n_junctions += 1
+        if n_junctions:
+            key = (n_junctions, not rec.flag & 0x900)
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+    def merge(self, other):
+        """Adds the counts of another splice collector."""
+        for key, count in other.counts.iteritems():
+            self.counts[key] = self.counts.get(key, 0) + count
+
+    def result(self, references):
+        """Returns the number of spliced (primary) alignments, their
+        junctions and the number of spliced alignments by number of
+        junctions."""
+        result = OrderedDict((key, 0) for key in ('alignments',
+            'primaryAlignments', 'junctions', 'primaryJunctions'))
+        hist = {}
+        for (n_junctions, primary), count in self.counts.iteritems():
+            result['alignments'] += count
+            result['junctions'] += n_junctions * count
+            if primary:
+                result['primaryAlignments'] += count
+                result['primaryJunctions'] += n_junctions * count
+            hist[n_junctions] = hist.get(n_junctions, 0) + count
+        result['histogram'] = [list(item) for item in sorted(hist.items())]
+        return result
+
+
+class JunctionCatalog(object):
+
+    """Class counting the alignments supporting each splice junction, by
+    reference sequence, donor, acceptor and strand.
+
+    Donor and acceptor are the 1-based first and last base of the intron,
+    as in the STAR junction table, on the reference strand. The strand is
+    taken from the XS tag of the alignment ('.' without a tag).
+
+    """
+
+    key = 'junctions'
+
+    # CIGAR operations consuming the reference (M, D, N, =, X)
+    REF_OPS = frozenset((0, 2, 3, 7, 8))
+    # strand codes of XS tag values, and back
+    STRAND_CODES = {'+': 1, '-': 2}
+    STRANDS = ('.', '+', '-')
+
+    def __init__(self):
+        # [alignments, primary alignments] by (reference index, donor,
+        # acceptor, strand code)
+        self.counts = {}
+
+    def add(self, rec):
+        """Counts the junctions of a record, if it is spliced."""
+        cigar = rec.cigartuples
+        if cigar is None or len(cigar) < 3:
+            return
+        pos = rec.pos
+        strand = None
+        for op, length in cigar:
+            if op == 3:
+                if strand is None:
+                    try:
+                        strand = self.STRAND_CODES.get(rec.opt('XS'), 0)
+                    except KeyError:
+                        strand = 0
+                    primary = not rec.flag & 0x900
+                key = (rec.tid, pos + 1, pos + length, strand)
+                counts = self.counts.get(key)
+                if counts is None:
+                    counts = self.counts[key] = [0, 0]
+                counts[0] += 1
+                if primary:
+                    counts[1] += 1
+            if op in self.REF_OPS:
+                pos += length
+
+    def merge(self, other):
+        """Adds the counts of another junction collector."""
+        for key, other_counts in other.counts.iteritems():
+            counts = self.counts.get(key)
+            if counts is None:
+                self.counts[key] = list(other_counts)
+            else:
+                counts[0] += other_counts[0]
+                counts[1] += other_counts[1]
+
+    def result(self, references):
+        """Returns the number of junctions and of their supporting
+        alignments, per strand."""
+        result = OrderedDict()
+        for strand in self.STRANDS:
+            result[strand] = OrderedDict((('junctions', 0),
+                ('alignments', 0), ('primaryAlignments', 0)))
+        for key, counts in self.counts.iteritems():
+            strand_result = result[self.STRANDS[key[3]]]
+            strand_result['junctions'] += 1
+            strand_result['alignments'] += counts[0]
+            strand_result['primaryAlignments'] += counts[1]
+        return result
+
+    def write_table(self, path, references):
+        """Writes the junctions as a tab-separated table, with a header line,
+        sorted by reference sequence and position.
+
+        :param path: path to the output file
+        :type path: str
+        :param references: names of the reference sequences, by index
+        :type references: list of str
+
+        """
+        with open(path, 'w') as handle:
+            handle.write('contig\tdonor\tacceptor\tstrand\talignments\t'
+                    'primaryAlignments\n')
+            for key in sorted(self.counts):
+                tid, donor, acceptor, strand = key
+                counts = self.counts[key]
+                handle.write('%s\t%d\t%d\t%s\t%d\t%d\n' % (references[tid],
+                    donor, acceptor, self.STRANDS[strand], counts[0],
+                    counts[1]))
+
+
+# collectors that can be enabled on the command line, by name
+COLLECTORS = OrderedDict((
+    ('contigs', ContigCounts),
+    ('insert-size', InsertSizeHistogram),
+    ('mapq', MapqHistogram),
+    ('splice', SpliceCounts),
+    ('junctions', JunctionCatalog),
+))
+
+
+def split_regions(bam, n_shards):
+    """Splits the reference sequences of a BAM file into shards of regions
+    with about equal total length.
+
+    Long reference sequences are split over multiple shards, and short ones
+    (e.g. contigs of draft assemblies) are packed together into one shard.
+
+    :param bam: BAM file
+    :type bam: pysam.Samfile
+    :param n_shards: approximate number of shards
+    :type n_shards: int
+    :returns: reference name, start and end of the regions of each shard
+    :rtype: list of list of tuple
+
+    """
+    size = max(sum(bam.lengths) // n_shards, 1)
+    shards, shard, shard_length = [], [], 0
+    for ref, length in zip(bam.references, bam.lengths):
+        start = 0
+        while start < length:
+            end = min(start + size - shard_length, length)
+            shard.append((ref, start, end))
+            shard_length += end - start
+            start = end
+            if shard_length >= size:
+                shards.append(shard)
+                shard, shard_length = [], 0
+    if shard:
+        shards.append(shard)
+    return shards
+
+
+# BAM file and groups of a pool worker process, see ``_init_worker``
+_worker = {}
+
+
+def _init_worker(bamfile, group_by):
+    """Opens the BAM file once per process of a process pool."""
+    bam = pysam.Samfile(bamfile, 'rb')
+    _worker['bam'] = bam
+    _worker['groups'] = Groups(bam, *group_by) if any(group_by) else None
+
+
+def _iter_shard(bam, shard):
+    """Yields the records starting in the regions of a shard, so records
+    overlapping multiple regions are yielded once."""
+    for ref, start, end in shard:
+        for rec in bam.fetch(ref, start, end):
+            if rec.pos >= start:
+                yield rec
+
+
+def _count_shard(args):
+    """Counts the records of a shard of a coordinate-sorted BAM file, for use
+    in a process pool set up by ``_init_worker``.
+
+    A shard of None counts the unmapped records without coordinates at the
+    end of the file. The (empty) collectors are returned with the counts,
+    after collecting the shard.
+
+    """
+    shard, suflen, primary_reads, partitions, collectors = args
+    bam = _worker['bam']
+    if shard is None:
+        records = bam.fetch('*')
+    else:
+        records = _iter_shard(bam, shard)
+    return count_records(records, suflen, primary_reads, partitions,
+            _worker['groups'], collectors) + (collectors,)
+
+
+def mask_counts_to_counts(mask_counts):
+    """Converts the number of records (or reads) of each tagged category
+    mask into counts per category, per group code.
+
+    :param mask_counts: number of records of each tagged mask
+    :type mask_counts: dict
+    :returns: count of each category, by group code (0 for all records)
+    :rtype: dict of dict
+
+    """
+    group_counts = {0: dict.fromkeys(FLAGS, 0)}
+    for tagged, count in mask_counts.iteritems():
+        if count:
+            code, mask = divmod(tagged, N_MASKS)
+            if code not in group_counts:
+                group_counts[code] = dict.fromkeys(FLAGS, 0)
+            counts = group_counts[code]
+            for flag, bit in BITS.items():
+                if mask & bit:
+                    counts[flag] += count
+    return group_counts
+
+
 class BarnStat(object):
 
     """Class representing a collection of BAM statistics for RNA-seq data."""
 
     def __init__(self, bamfile, read_pair_suffix_len=0, id_sorted=False,
-            validate=False):
-        assert os.path.exists(bamfile), "BAM file %r not found." % bamfile
+            validate=False, primary_reads=False, partitions=0, tmp_dir=None,
+            processes=1, by_reference=False, by_read_group=False,
+            collectors=(), checkpoint=None,
+            checkpoint_interval=CHECKPOINT_INTERVAL):
+        assert bamfile == '-' or os.path.exists(bamfile), \
+                "BAM file %r not found." % bamfile
+        assert bamfile != '-' or processes == 1, \
+                "Multiple processes can not be used with stdin input."
+        assert checkpoint is None or (bamfile != '-' and processes == 1), \
+                "Checkpoints require a BAM file counted in one process."
         self.validate = validate
         self.bamfile = bamfile
+        # breakdowns of the counts, see ``Groups``
+        self.group_by = (by_reference, by_read_group)
+        self.groups = None
+        # collectors of additional statistics, see ``COLLECTORS``
+        self.collectors = list(collectors)
+        self.references = []
 
         self.flags = FLAGS.keys()
         # length of read pair suffix (e.g. '/2' has len == 2)
         self.suflen = read_pair_suffix_len
-        if not id_sorted:
-            self._count_unsorted()
-        else:
+        sorted_mode = id_sorted and not primary_reads
+        self.checkpoint = None
+        if checkpoint is not None:
+            # a checkpoint is only resumed for the same file and options
+            stat = os.stat(bamfile)
+            self.checkpoint = Checkpoint(checkpoint, (
+                os.path.abspath(bamfile), stat.st_size, stat.st_mtime,
+                self.suflen, sorted_mode, primary_reads, partitions,
+                self.group_by, [type(c).__name__ for c in self.collectors]),
+                checkpoint_interval)
+        if sorted_mode:
             self._count_sorted()
+        else:
+            self._count_unsorted(primary_reads, partitions, tmp_dir, processes)
+        if self.checkpoint is not None:
+            self.checkpoint.remove()
 
         self._format_counts()
 
@@ -106,16 +953,60 @@ class BarnStat(object):
 
         return alns, reads
 
+    def _open_bam(self):
+        """Opens the BAM file and sets the reference names and the groups to
+        count, from its header."""
+        bam = open_bam(self.bamfile)
+        self.references = list(bam.references)
+        if any(self.group_by):
+            self.groups = Groups(bam, *self.group_by)
+        return bam
+
+    def _set_counts(self, alns, alns_qc, reads):
+        """Sets the counts of all records and of each group from the number
+        of alignments, QC-failed alignments and reads of each tagged mask."""
+        alns = mask_counts_to_counts(alns)
+        alns_qc = mask_counts_to_counts(alns_qc)
+        reads = mask_counts_to_counts(reads)
+        self.group_counts = {}
+        for code in sorted(alns):
+            if code not in reads:
+                reads[code] = dict.fromkeys(FLAGS, 0)
+            aln_counts, read_counts = self._adjust_counts(alns[code],
+                    reads[code])
+            aln_qc_counts = alns_qc.get(code, dict.fromkeys(FLAGS, 0))
+            if code == 0:
+                self.aln_counts, self.read_counts = aln_counts, read_counts
+                self.aln_qc_counts = aln_qc_counts
+            else:
+                self.group_counts[code] = (read_counts, aln_counts,
+                        aln_qc_counts)
+
     def _count_sorted(self):
         """Counts read and alignment statistics for ID-sorted BAM file."""
-        flags = self.flags
-        reads, alns, alns_qc = {}, {}, {}
-        read_flags = dict.fromkeys(flags, False)
+        reads, alns, alns_qc = [0] * N_MASKS, [0] * N_MASKS, [0] * N_MASKS
+        group_reads, group_alns, group_alns_qc = Counter(), Counter(), Counter()
+        read_mask = 0
+        # mask of the current read in each of its groups, by group tag
+        group_masks = {}
         cur_qname = None
-
-        # init counts
-        for flag in flags:
-            reads[flag], alns[flag], alns_qc[flag] = 0, 0, 0
+        bam = self._open_bam()
+        groups = self.groups
+        collectors = self.collectors
+        checkpoint = self.checkpoint
+        if checkpoint is not None and checkpoint.state is not None:
+            state = checkpoint.state
+            reads, alns, alns_qc = (state['reads'], state['alns'],
+                    state['alns_qc'])
+            group_reads, group_alns, group_alns_qc = (state['group_reads'],
+                    state['group_alns'], state['group_alns_qc'])
+            # the read in flight
+            read_mask, group_masks, cur_qname = (state['read_mask'],
+                    state['group_masks'], state['cur_qname'])
+            for collector, saved in zip(collectors, state['collectors']):
+                collector.merge(saved)
+            bam.seek(checkpoint.offset)
+        n_left = CHECKPOINT_RECORDS
 
         # iterate over each record
         # index for suffix removal, if suffix exist (> 0)
@@ -123,173 +1014,165 @@ class BarnStat(object):
             sufslice = slice(-self.suflen)
         else:
             sufslice = slice(None)
-        for rec in pysam.Samfile(self.bamfile, 'rb'):
+        for rec in bam:
             # different qname mean we've finished parsing each unique read
-            # so reset the flags and add them to the counters appropriately
-            if cur_qname != rec.qname[sufslice]:
-                for flag in flags:
-                    reads[flag] += int(read_flags[flag])
-                # reset the qname tracker
-                cur_qname = rec.qname[sufslice]
-                # and the read flag tracker
-                read_flags = dict.fromkeys(flags, False)
-            # total, total splice
-            alns['total'] += 1
-            alns_qc['total'] += func_qc(rec)
-            read_flags['total'] = True
-            if func_splice(rec):
-                alns['totalSplice'] += 1
-                alns_qc['totalSplice'] += func_qc(rec)
-                read_flags['totalSplice'] = True
-            # unmapped
-            if func_nunmap(rec):
-                alns['unmapped'] += 1
-                alns_qc['unmapped'] += func_qc(rec)
-                read_flags['unmapped'] = True
-            else:
-                # mapped
-                if func_nmap(rec):
-                    alns['mapped'] += 1
-                    alns_qc['mapped'] += func_qc(rec)
-                    read_flags['mapped'] = True
-                    # mapped pairs
-                    if func_nmap_pair(rec):
-                        alns['mappedPair'] += 1
-                        alns_qc['mappedPair'] += func_qc(rec)
-                        read_flags['mappedPair'] = True
-                        # proper pairs, proper pairs splice
-                        if func_nmap_pair_ok(rec):
-                            alns['mappedPairProper'] += 1
-                            alns_qc['mappedPairProper'] += func_qc(rec)
-                            read_flags['mappedPairProper'] = True
-                            if func_splice(rec):
-                                alns['splicePairProper'] += 1
-                                alns_qc['splicePairProper'] += func_qc(rec)
-                                read_flags['splicePairProper'] = True
-                        # mapped to different chromosomes
-                        elif func_nmap_diffchr(rec):
-                            alns['mappedDiffChr'] += 1
-                            alns_qc['mappedDiffChr'] += func_qc(rec)
-                            read_flags['mappedDiffChr'] = True
-                            if rec.mapq >= 5:
-                                alns['mappedDiffChrQ'] += 1
-                                alns_qc['mappedDiffChrQ'] += func_qc(rec)
-                                read_flags['mappedDiffChrQ'] = True
-                    # singletons, singletons splice
-                    elif func_nmap_sgltn(rec):
-                        alns['singleton'] += 1
-                        alns_qc['singleton'] += func_qc(rec)
-                        read_flags['singleton'] = True
-                        if func_splice(rec):
-                            alns['spliceSingleton'] += 1
-                            alns_qc['spliceSingleton'] += func_qc(rec)
-                            read_flags['spliceSingleton'] = True
+            # so add its categories to the counters and reset them
+            qname = rec.qname[sufslice]
+            if cur_qname != qname:
+                reads[read_mask] += 1
+                for tag, mask in group_masks.iteritems():
+                    group_reads[mask + tag] += 1
+                cur_qname = qname
+                read_mask = 0
+                group_masks = {}
+            mask = record_mask(rec)
+            alns[mask] += 1
+            if rec.flag & 0x200:
+                alns_qc[mask] += 1
+            read_mask |= mask
+            for collector in collectors:
+                collector.add(rec)
+            if groups is not None:
+                for tag, _ in groups.tags(rec):
+                    group_alns[mask + tag] += 1
+                    if rec.flag & 0x200:
+                        group_alns_qc[mask + tag] += 1
+                    group_masks[tag] = group_masks.get(tag, 0) | mask
+            if checkpoint is not None:
+                n_left -= 1
+                if not n_left:
+                    n_left = CHECKPOINT_RECORDS
+                    if checkpoint.due():
+                        checkpoint.save(bam.tell(), {'reads': reads,
+                            'alns': alns, 'alns_qc': alns_qc,
+                            'group_reads': group_reads,
+                            'group_alns': group_alns,
+                            'group_alns_qc': group_alns_qc,
+                            'read_mask': read_mask,
+                            'group_masks': group_masks,
+                            'cur_qname': cur_qname,
+                            'collectors': collectors})
 
         # for the last read, since we don't pass the qname check again
-        for flag in flags:
-            reads[flag] += int(read_flags[flag])
+        reads[read_mask] += 1
+        for tag, mask in group_masks.iteritems():
+            group_reads[mask + tag] += 1
+        bam.close()
 
-        self.aln_counts, self.read_counts = self._adjust_counts(alns, reads)
-        self.aln_qc_counts = alns_qc
+        group_reads.update(dict(enumerate(reads)))
+        group_alns.update(dict(enumerate(alns)))
+        group_alns_qc.update(dict(enumerate(alns_qc)))
+        self._set_counts(group_alns, group_alns_qc, group_reads)
         if self.validate:
             assert self.validate_counts()
 
-    def _count_unsorted(self):
-        """Counts read and alignment statistics for non-ID-sorted BAM file."""
-        flags = self.flags
-        reads_total, reads_unmap, reads_map, reads_pair_map, reads_pair_proper, \
-                reads_sgltn, reads_total_splice, reads_pair_proper_splice, \
-                reads_sgltn_splice, reads_pair_diffchr, reads_pair_diffchr_h = \
-                set(), set(), set(), set(), set(), set(), set(), set(), set(), \
-                set(), set()
-
-        reads, alns, alns_qc = {}, {}, {}
-        for flag in flags:
-            reads[flag], alns[flag], alns_qc[flag] = 0, 0, 0
-        # index for suffix removal, if suffix exist (> 0)
-        if self.suflen:
-            sufslice = slice(-self.suflen)
-        else:
-            sufslice = slice(None)
-        for rec in pysam.Samfile(self.bamfile, 'rb'):
-            # remove '/1' or '/2' suffixes, to collapse read pair counts
-            pass
-            # do countings on alns and reads directly
-            hname = hash(rec.qname[sufslice])
-            # total, total splice
-            alns['total'] += 1
-            alns_qc['total'] += func_qc(rec)
-            if hname not in reads_total:
-                reads_total.add(hname)
-            if func_splice(rec):
-                alns['totalSplice'] += 1
-                alns_qc['totalSplice'] += func_qc(rec)
-                reads_total_splice.add(hname)
-            # unmapped
-            if func_nunmap(rec):
-                alns['unmapped'] += 1
-                alns_qc['unmapped'] += func_qc(rec)
-                reads_unmap.add(hname)
+    def _count_unsorted(self, primary_reads=False, partitions=0,
+            tmp_dir=None, processes=1):
+        """Counts read and alignment statistics for non-ID-sorted BAM file.
+
+        Reads are counted by combining the categories of all records with
+        the same name (hash), which are kept in memory or, with
+        ``partitions``, written to that number of temporary partition files
+        by name hash and combined per partition.
+
+        With ``primary_reads``, each read (pair) is counted once, at the
+        primary alignment of its first read, in the categories of that
+        alignment and of the primary alignment of its mate (see
+        ``mate_mask``). Read names are not tracked, so memory usage does not
+        depend on the number of reads, but categories of secondary and
+        supplementary alignments are not counted for reads.
+
+        With multiple ``processes``, the BAM file must be coordinate-sorted
+        and indexed. Its reference sequences are split into shards of
+        regions with about equal total length (see ``split_regions``), which
+        are counted in a process pool that opens the BAM file once per
+        process, followed by the unmapped records at the end of the file.
+
+        With groups (see ``Groups``), the reads of each group are tracked
+        separately, by salted name hash, so the number of tracked read
+        names grows with the number of breakdowns.
+
+        With a checkpoint, partition files are kept in its work directory,
+        so they can be appended to when resuming.
+
+        """
+        checkpoint = self.checkpoint
+        work_dir = None
+        if partitions and not primary_reads:
+            if checkpoint is None:
+                work_dir = tempfile.mkdtemp(prefix='bam_rna.', dir=tmp_dir)
+            else:
+                work_dir = checkpoint.work_dir
+                if not os.path.isdir(work_dir):
+                    os.makedirs(work_dir)
+        bam = self._open_bam()
+        pool = None
+        if processes > 1:
+            pool = multiprocessing.Pool(processes, _init_worker,
+                    (self.bamfile, self.group_by))
+        try:
+            if pool is None:
+                shards = [None]
+            else:
+                shards = split_regions(bam, SHARDS_PER_PROCESS * processes)
+                shards.append(None)
+                bam.close()
+            # partition files of each shard
+            shard_paths = [None] * len(shards)
+            if work_dir is not None:
+                shard_paths = [[os.path.join(work_dir, '%d.%d.part' %
+                    (shard, idx)) for idx in range(partitions)]
+                    for shard in range(len(shards))]
+
+            if pool is None:
+                results = [count_records(bam, self.suflen, primary_reads,
+                    shard_paths[0], self.groups, self.collectors, checkpoint)]
+                bam.close()
             else:
-                # mapped
-                if func_nmap(rec):
-                    alns['mapped'] += 1
-                    alns_qc['mapped'] += func_qc(rec)
-                    reads_map.add(hname)
-                    # mapped pairs
-                    if func_nmap_pair(rec):
-                        alns['mappedPair'] += 1
-                        alns_qc['mappedPair'] += func_qc(rec)
-                        reads_pair_map.add(hname)
-                        # proper pairs, proper pairs splice
-                        if func_nmap_pair_ok(rec):
-                            alns['mappedPairProper'] += 1
-                            alns_qc['mappedPairProper'] += func_qc(rec)
-                            reads_pair_proper.add(hname)
-                            if func_splice(rec):
-                                alns['splicePairProper'] += 1
-                                alns_qc['splicePairProper'] += func_qc(rec)
-                                reads_pair_proper_splice.add(hname)
-                        # mapped to different chromosomes
-                        elif func_nmap_diffchr(rec):
-                            alns['mappedDiffChr'] += 1
-                            alns_qc['mappedDiffChr'] += func_qc(rec)
-                            reads_pair_diffchr.add(hname)
-                            if rec.mapq >= 5:
-                                alns['mappedDiffChrQ'] += 1
-                                alns_qc['mappedDiffChrQ'] += func_qc(rec)
-                                reads_pair_diffchr_h.add(hname)
-                    # singletons, singletons splice
-                    elif func_nmap_sgltn(rec):
-                        alns['singleton'] += 1
-                        alns_qc['singleton'] += func_qc(rec)
-                        reads_sgltn.add(hname)
-                        if func_splice(rec):
-                            alns['spliceSingleton'] += 1
-                            alns_qc['spliceSingleton'] += func_qc(rec)
-                            reads_sgltn_splice.add(hname)
-
-        # set counts for reads
-        reads['total'] = len(reads_total)
-        reads['totalSplice'] = len(reads_total_splice)
-        reads['unmapped'] = len(reads_unmap)
-        reads['mapped'] = len(reads_map)
-        reads['mappedPair'] = len(reads_pair_map)
-        reads['mappedPairProper'] = len(reads_pair_proper)
-        reads['mappedDiffChr'] = len(reads_pair_diffchr)
-        reads['mappedDiffChrQ'] = len(reads_pair_diffchr_h)
-        reads['splicePairProper'] = len(reads_pair_proper_splice)
-        reads['singleton'] = len(reads_sgltn)
-        reads['spliceSingleton'] = len(reads_sgltn_splice)
-
-        # free the memory
-        del reads_total, reads_map, reads_pair_map, reads_pair_proper,  \
-                reads_sgltn, reads_total_splice, reads_pair_proper_splice, \
-                reads_sgltn_splice, reads_unmap, reads_pair_diffchr, \
-                reads_pair_diffchr_h
-
-        self.aln_counts, self.read_counts = self._adjust_counts(alns, reads)
-        self.aln_qc_counts = alns_qc
+                # each shard collects into copies of the (empty) collectors
+                results = pool.map(_count_shard, [(shard, self.suflen,
+                    primary_reads, paths, self.collectors)
+                    for shard, paths in zip(shards, shard_paths)], chunksize=1)
+                for result in results:
+                    for collector, shard_collector in zip(self.collectors,
+                            result[3]):
+                        collector.merge(shard_collector)
+                results = [result[:3] for result in results]
+
+            alns, alns_qc, reads = Counter(), Counter(), Counter()
+            read_masks = {}
+            for shard_alns, shard_alns_qc, shard_reads in results:
+                alns.update(shard_alns)
+                alns_qc.update(shard_alns_qc)
+                if primary_reads:
+                    reads.update(shard_reads)
+                elif work_dir is None:
+                    for hname, mask in shard_reads.iteritems():
+                        read_masks[hname] = read_masks.get(hname, 0) | mask
+            del results
+
+            # set counts for reads
+            if work_dir is not None:
+                partition_paths = zip(*shard_paths)
+                if pool is None:
+                    partition_reads = map(reduce_partition, partition_paths)
+                else:
+                    partition_reads = pool.map(reduce_partition,
+                            partition_paths, chunksize=1)
+                for part_reads in partition_reads:
+                    reads.update(part_reads)
+            elif not primary_reads:
+                reads = count_read_masks(read_masks)
+                # free the memory
+                del read_masks
+        finally:
+            if pool is not None:
+                pool.terminate()
+            # the work directory of a checkpoint is removed with it
+            if work_dir is not None and checkpoint is None:
+                shutil.rmtree(work_dir, ignore_errors=True)
+
+        self._set_counts(alns, alns_qc, reads)
         if self.validate:
             assert self.validate_counts()
 
@@ -335,23 +1218,31 @@ class BarnStat(object):
 
     def _format_counts(self):
         """Formats read and alignment counts into nice-looking numbers."""
+        counts = self._format_level_counts(self.read_counts, self.aln_counts,
+                self.aln_qc_counts)
+        if self.groups is not None:
+            for kind, enabled in zip(self.groups.kinds, self.group_by):
+                if enabled:
+                    counts[kind] = OrderedDict()
+            for code in sorted(self.group_counts):
+                kind, name = self.groups.group(code)
+                counts[kind][name] = self._format_level_counts(
+                        *self.group_counts[code])
+        for collector in self.collectors:
+            counts[collector.key] = collector.result(self.references)
+
+        self.counts = counts
+
+    def _format_level_counts(self, read_counts, aln_counts, aln_qc_counts):
+        """Formats the read, alignment and QC-failed alignment counts of all
+        records or of a group."""
         counts = OrderedDict()
         flags = self.flags
-        for ctype in ('read_counts', 'aln_counts', 'aln_qc_counts'):
-            count = getattr(self, ctype)
-
+        for lvl, count in (('read', read_counts), ('aln', aln_counts),
+                ('aln_qc', aln_qc_counts)):
             ntotal = count['total']
-            cont = {} 
-            lvl = 'aln' if ctype == 'aln_counts' else 'read'
-
-            if ctype == 'aln_qc_counts':
-                lvl = 'aln_qc'
-            else:
-                pct = lambda x: x * 100.0 / ntotal
-                if ctype == 'read_counts':
-                    lvl = 'read'
-                elif ctype == 'aln_counts':
-                    lvl = 'aln'
+            cont = {}
+            pct = lambda x: x * 100.0 / ntotal
 
             for flag in flags:
                 # format all counts
@@ -365,15 +1256,55 @@ class BarnStat(object):
 
             counts[lvl] = cont
 
-        self.counts = counts
+        return counts
 
 
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser()
-    parser.add_argument('bamfile', help='Path to BAM file')
+    parser.add_argument('bamfile', help='Path to BAM file, or \'-\' to read '
+            'SAM or BAM from stdin (e.g. tee\'d from the aligner)')
     parser.add_argument('--id-sorted', action='store_true',
             dest='id_sorted', help='Whether the BAM file is ID-sorted or not')
+    parser.add_argument('--primary-reads', action='store_true',
+            dest='primary_reads', help='Count reads from their primary '
+            'alignments and mate information instead of tracking read names, '
+            'using constant memory. Requires the MC and MQ tags of paired '
+            'alignments with a mapped mate (not written by all aligners); '
+            'secondary and supplementary alignments are ignored for the read '
+            'counts')
+    parser.add_argument('--partitions', type=int, dest='partitions',
+            default=0, help='Number of temporary files to spill read names '
+            'to, for exact read counts of non-ID-sorted BAM files with '
+            'bounded memory (default: keep read names in memory)')
+    parser.add_argument('--tmp-dir', type=str, dest='tmp_dir',
+            help='Directory for the temporary files of --partitions '
+            '(default: system temporary directory)')
+    parser.add_argument('--processes', '--threads', type=int,
+            dest='processes', default=1, help='Number of processes to count '
+            'regions of a coordinate-sorted and indexed BAM file with')
+    parser.add_argument('--by-reference', action='store_true',
+            dest='by_reference', help='Also count per reference sequence '
+            '(chromosome), by the reference of each alignment')
+    parser.add_argument('--by-read-group', action='store_true',
+            dest='by_read_group', help='Also count per read group in the BAM '
+            'header, by the RG tag of each alignment')
+    parser.add_argument('--collect', action='append', dest='collect',
+            choices=COLLECTORS.keys(), default=[], help='Also collect the '
+            'given statistics in the same pass over the BAM file; may be '
+            'given multiple times')
+    parser.add_argument('--junctions-out', type=str, dest='junctions_out',
+            help='Path to write a table of the alignments supporting each '
+            'splice junction to (implies --collect junctions)')
+    parser.add_argument('--checkpoint', type=str, dest='checkpoint',
+            help='Path to periodically save the counting state to, and to '
+            'resume counting from if it exists; removed when counting '
+            'finishes. Saving is cheapest with --id-sorted, --primary-reads '
+            'or --partitions')
+    parser.add_argument('--checkpoint-interval', type=int,
+            dest='checkpoint_interval', default=CHECKPOINT_INTERVAL,
+            help='Number of seconds between checkpoints (default: '
+            '%(default)s)')
     parser.add_argument('--suffix-len', type=int, dest='suffix_len', default=0,
             help='Length of read pair suffix, if present')
     parser.add_argument('-o', '--outfile', dest='out_file', type=str,
@@ -383,7 +1314,36 @@ if __name__ == '__main__':
             help='Format of output file')
     args = parser.parse_args()
 
-    bamstat = BarnStat(args.bamfile, args.suffix_len, args.id_sorted)
+    if args.partitions < 0:
+        parser.error("Number of partitions must not be negative")
+    if args.processes < 1:
+        parser.error("Number of processes must be at least 1")
+    if args.processes > 1 and args.id_sorted and not args.primary_reads:
+        parser.error("ID-sorted BAM files can not be counted in multiple "
+                "processes")
+    if args.processes > 1 and args.bamfile == '-':
+        parser.error("Multiple processes can not be used with stdin input")
+    if args.processes > 1 and not any(os.path.exists(path) for path in
+            (args.bamfile + '.bai', args.bamfile + '.csi',
+                os.path.splitext(args.bamfile)[0] + '.bai')):
+        parser.error("Counting in multiple processes requires an indexed "
+                "BAM file")
+    if args.checkpoint is not None and (args.processes > 1 or
+            args.bamfile == '-'):
+        parser.error("Checkpoints require a BAM file counted in one process")
+    if args.junctions_out is not None:
+        args.collect.append('junctions')
+    collectors = OrderedDict((name, COLLECTORS[name]()) for name in
+            args.collect)
+    bamstat = BarnStat(args.bamfile, args.suffix_len, args.id_sorted,
+            primary_reads=args.primary_reads, partitions=args.partitions,
+            tmp_dir=args.tmp_dir, processes=args.processes,
+            by_reference=args.by_reference, by_read_group=args.by_read_group,
+            collectors=collectors.values(), checkpoint=args.checkpoint,
+            checkpoint_interval=args.checkpoint_interval)
+    if args.junctions_out is not None:
+        collectors['junctions'].write_table(args.junctions_out,
+                bamstat.references)
 
     if args.out_file is None:
         bamstat.show()
@@ -22,16 +22,18 @@
 # output the annotation metrics using Picard CollectRnaSeqMetrics per chromosome
 
 import argparse
+import collections
 import json
 import functools
 import locale
 import os
 import subprocess
+import sys
 import threading
-import time
 import tempfile
 import warnings
-import Queue
+
+import pysam
 
 # valid column names
 # from http://picard.sourceforge.net/picard-metric-definitions.shtml#RnaSeqMetrics
@@ -62,6 +64,8 @@ COL_NAMES = {
 # executables, default to ones in PATH
 EXE_SAMTOOLS = 'samtools'
 EXE_JAVA = 'java'
+# flags of records not counted per chromosome by default (unmapped)
+EXCLUDE_FLAGS = 0x4
 
 # set locale to group digits
 locale.setlocale(locale.LC_ALL, '')
@@ -96,42 +100,118 @@ class MetricsTracker(object):
                         "chromosome {1}".format(bam, chr)
 
 
-class Worker(threading.Thread):
-
-    """Class representing worker to execute jobs."""
+class JobRunner(object):
 
-    def __init__(self, queue, group=None, target=None, name=None, args=(),
-            kwargs={}):
-        threading.Thread.__init__(self, group, target, name, args, kwargs)
-        self.queue = queue
-        self.setDaemon(True)
-        self.start()
-
-    def run(self):
-        while True:
-            func, args, kwargs = self.queue.get()
-            func(*args, **kwargs)
-            self.queue.task_done()
+    """Class running jobs in threads, with at most a given number of jobs
+    and a given total (JVM) memory of jobs running at the same time.
 
+    Jobs start their processes through ``call``, which waits for the
+    process to exit, so a finished job frees its slot without delay. The
+    first job to fail cancels the queued jobs and kills the processes of
+    the running ones, and its exception is raised by ``wait_completion``.
 
-class ThreadPool(object):
-
-    """Class representing thread pool to execute."""
-
-    def __init__(self, num_threads):
-        self.queue = Queue.Queue()
-        for _ in range(num_threads):
-            Worker(self.queue)
+    """
 
-    def add_task(self, func, *args, **kwargs):
-        self.queue.put((func, args, kwargs))
+    def __init__(self, num_threads, memory=None):
+        """
+
+        :param num_threads: maximum number of jobs running at the same time
+        :type num_threads: int
+        :param memory: maximum total memory (MB) of the jobs running at the
+            same time, or None for no limit
+        :type memory: int
+
+        """
+        self.num_threads = num_threads
+        self.memory = memory
+        self._cond = threading.Condition()
+        self._queue = collections.deque()
+        self._running = 0
+        self._memory_used = 0
+        self._procs = set()
+        # exception info of the first failed job
+        self._error = None
+        self._cancelled = False
+
+    def add_task(self, func, memory=0, **kwargs):
+        """Queues a job calling ``func`` with the runner and the given
+        keyword arguments, using the given memory (MB)."""
+        assert self.memory is None or memory <= self.memory, \
+                "Job memory {0} exceeds the memory limit".format(memory)
+        self._queue.append((func, kwargs, memory))
+
+    def call(self, tokens, **kwargs):
+        """Runs a process for a job and waits for it to exit.
+
+        Raises ``subprocess.CalledProcessError`` if it exits with an error,
+        or if the runner was cancelled.
+
+        """
+        with self._cond:
+            if self._cancelled:
+                raise subprocess.CalledProcessError(-1, tokens)
+            proc = subprocess.Popen(tokens, **kwargs)
+            self._procs.add(proc)
+        try:
+            retcode = proc.wait()
+        finally:
+            with self._cond:
+                self._procs.discard(proc)
+        if retcode:
+            raise subprocess.CalledProcessError(retcode, tokens)
+
+    def _run(self, func, kwargs, memory):
+        try:
+            func(runner=self, **kwargs)
+        except Exception:
+            with self._cond:
+                if self._error is None:
+                    self._error = sys.exc_info()
+        finally:
+            with self._cond:
+                self._running -= 1
+                self._memory_used -= memory
+                self._cond.notify_all()
+
+    def _can_start(self, memory):
+        if self._running >= self.num_threads:
+            return False
+        return self.memory is None or self._memory_used + memory <= \
+                self.memory
 
     def wait_completion(self):
-        self.queue.join()
-
-
-def picard_metrics_worker(in_bam, chr, tracker, annot, jar,
-        samtools_exe, java_exe):
+        """Runs the queued jobs and waits until all finished, or until one
+        failed and the other running jobs were stopped."""
+        with self._cond:
+            while self._error is None and (self._queue or self._running):
+                while self._queue and self._can_start(self._queue[0][2]):
+                    func, kwargs, memory = self._queue.popleft()
+                    self._running += 1
+                    self._memory_used += memory
+                    worker = threading.Thread(target=self._run,
+                            args=(func, kwargs, memory))
+                    worker.daemon = True
+                    worker.start()
+                self._cond.wait()
+            if self._error is None:
+                return
+            # cancel the remaining work
+            self._cancelled = True
+            self._queue.clear()
+            for proc in self._procs:
+                try:
+                    proc.kill()
+                except OSError:
+                    pass
+            # let the running jobs clean up before the interpreter exits
+            while self._running:
+                self._cond.wait()
+            exc_type, exc_value, exc_tb = self._error
+        raise exc_type, exc_value, exc_tb
+
+
+def picard_metrics_worker(runner, in_bam, chr, tracker, annot, jar,
+        samtools_exe, java_exe, job_memory=None):
     """Worker for collecting RNA-seq metrics."""
     # check if index exists
     assert os.path.exists(in_bam + '.bai')
@@ -148,54 +228,109 @@ def picard_metrics_worker(in_bam, chr, tracker, annot, jar,
         chr = 'ALL'
     out_stat = os.path.join(out_dir, chr + '.rna_metrics.txt')
     # split BAM file per chr, write to tmp file
-    if chr != 'ALL':
-        bam = tempfile.NamedTemporaryFile(prefix='tmp_rna_metrics_', delete=True)
-        name = bam.name
-        tokens = [samtools_exe, 'view', '-bh', '-o', bam.name, in_bam, chr]
-        proc = subprocess.Popen(tokens, stdout=bam)
-        while proc.poll() is None:
-            time.sleep(1)
-    else:
-        name = in_bam
-    picard_toks = [java_exe, '-jar', jar]
-    for key, value in os.environ.items():
-        if key.startswith('OPT_PICARD_COLLECTRNASEQMETRICS_'):
-            # input, output, and annotation are handled separately
-            if key.endswith('INPUT') or key.endswith('OUTPUT') or \
-                key.endswith('REF_FLAT'):
-                continue
-            if value:
-                picard_toks.append('%s=%s' %
-                        (key.replace('OPT_PICARD_COLLECTRNASEQMETRICS_', ''), value))
-
-    picard_toks += ['REF_FLAT={0}'.format(annot),
-            'STRAND_SPECIFICITY=SECOND_READ_TRANSCRIPTION_STRAND',
-            'I={0}'.format(name), 'O={0}'.format(out_stat)]
-    picard = subprocess.Popen(picard_toks)
-    while picard.poll() is None:
-        time.sleep(1)
+    bam = None
+    try:
+        if chr != 'ALL':
+            bam = tempfile.NamedTemporaryFile(prefix='tmp_rna_metrics_',
+                    delete=True)
+            name = bam.name
+            tokens = [samtools_exe, 'view', '-bh', '-o', bam.name, in_bam, chr]
+            runner.call(tokens, stdout=bam)
+        else:
+            name = in_bam
+        picard_toks = [java_exe]
+        if job_memory is not None:
+            picard_toks.append('-Xmx{0}m'.format(job_memory))
+        picard_toks += ['-jar', jar]
+        for key, value in os.environ.items():
+            if key.startswith('OPT_PICARD_COLLECTRNASEQMETRICS_'):
+                # input, output, and annotation are handled separately
+                if key.endswith('INPUT') or key.endswith('OUTPUT') or \
+                    key.endswith('REF_FLAT'):
+                    continue
+                if value:
+                    picard_toks.append('%s=%s' %
+                            (key.replace('OPT_PICARD_COLLECTRNASEQMETRICS_',
+                                ''), value))
+
+        picard_toks += ['REF_FLAT={0}'.format(annot),
+                'STRAND_SPECIFICITY=SECOND_READ_TRANSCRIPTION_STRAND',
+                'I={0}'.format(name), 'O={0}'.format(out_stat)]
+        runner.call(picard_toks)
+    finally:
+        if bam is not None:
+            bam.close()
     assert os.path.exists(out_stat)
-    if chr != 'ALL':
-        bam.close()
     tracker.add_stat_file(in_bam, chr, out_stat)
 
 
-def samtools_reads_per_region_count(bam_files, chrs, samtools_exe):
-    """Counts read per chromosome using samtools (simple count of mapped read
-    per region."""
-    tokens = [samtools_exe, 'view', '-c', '-F', '0x4']
+def index_mapped_count(bam, chrs):
+    """Counts mapped reads per chromosome from the mapping statistics in the
+    BAM index, like samtools idxstats, without reading any alignment.
+
+    Raises ValueError if the index does not record mapping statistics.
+
+    """
+    bamfile = pysam.Samfile(bam, 'rb')
+    try:
+        stats = bamfile.get_index_statistics()
+        # indices without statistics report zero reads for every chromosome,
+        # so zero totals are only trusted when no read is on a chromosome
+        # (unplaced reads are sorted last)
+        if sum(stat.total for stat in stats) == 0:
+            first = next(bamfile.fetch(until_eof=True), None)
+            if first is not None and first.tid >= 0:
+                raise ValueError("No mapping statistics in the index of "
+                        "{0}".format(bam))
+        mapped = dict((stat.contig, stat.mapped) for stat in stats)
+    finally:
+        bamfile.close()
+    return dict((chr, mapped.get(chr, 0)) for chr in chrs)
+
+
+def pass_reads_count(bam, chrs, exclude_flags=EXCLUDE_FLAGS):
+    """Counts reads per chromosome in one pass over the BAM file, skipping
+    records with any of the given flags set (like samtools view -c -F)."""
+    bamfile = pysam.Samfile(bam, 'rb')
+    try:
+        counts = [0] * bamfile.nreferences
+        for rec in bamfile.fetch(until_eof=True):
+            # records without a reference are not in any chromosome
+            if rec.tid >= 0 and not rec.flag & exclude_flags:
+                counts[rec.tid] += 1
+        counts = dict(zip(bamfile.references, counts))
+    finally:
+        bamfile.close()
+    return dict((chr, counts.get(chr, 0)) for chr in chrs)
+
+
+def reads_per_region_count(bam_files, chrs, exclude_flags=EXCLUDE_FLAGS):
+    """Counts read per chromosome (simple count of mapped reads per region).
+
+    Mapped reads are taken from the BAM index in constant time. Other
+    flag filters, or an index without mapping statistics, need one pass
+    over the BAM file.
+
+    """
     keys = ['fwd', 'rev', 'mix']
     all_dict = dict.fromkeys(keys)
     for rtype, bam in bam_files.items():
         assert rtype in keys, "Unknown key: {0}".format(rtype)
+        counts = None
+        if exclude_flags == 0x4:
+            try:
+                counts = index_mapped_count(bam, chrs)
+            except ValueError:
+                warnings.warn("No mapping statistics in the index of {0}, "
+                        "counting its alignments instead".format(bam))
+        if counts is None:
+            counts = pass_reads_count(bam, chrs, exclude_flags)
         aggr_dict = {}
         for chr in chrs:
             if chr == 'ALL':
                 continue
-            proc = subprocess.Popen(tokens + [bam, chr], stdout=subprocess.PIPE)
-            count = int(proc.stdout.read())
             aggr_dict[chr] = {
-                'metrics': {'countMapped': count}    
+                'metrics': {'countMapped': counts[chr]}
             }
         name = os.path.basename(os.path.splitext(bam)[0])
         all_dict[rtype] = {}
@@ -205,22 +340,31 @@ def samtools_reads_per_region_count(bam_files, chrs, samtools_exe):
     return all_dict
 
 
-def picard_reads_per_region_count(bam_files, chrs, annot, jar, samtools_exe, java_exe):
-    """Counts read per chromosome using Picard and annotation files."""
+def picard_reads_per_region_count(bam_files, chrs, annot, jar, samtools_exe,
+        java_exe, threads=1, memory=None, job_memory=None):
+    """Counts read per chromosome using Picard and annotation files.
+
+    At most ``threads`` Picard jobs run at the same time and, with a
+    ``memory`` limit (MB), at most that total of ``job_memory`` (MB, the
+    JVM maximum heap size of each job).
+
+    """
     assert os.path.exists(annot), "Annotation file {0} not found".format(annot)
     # only analyze sense and antisense reads
     bam_files = {'fwd': bam_files['fwd'], 'rev': bam_files['rev']}
     # create tracker for metric files
     metrics_tracker = MetricsTracker(bam_files, chrs)
-    # create main task pool
-    metrics_pool = ThreadPool(args.threads)
-    # add tasks to the pool
+    # create main job runner
+    metrics_runner = JobRunner(threads, memory)
+    # add tasks to the runner
     for bam in bam_files.values():
         for chr in chrs:
-            metrics_pool.add_task(picard_metrics_worker, in_bam=bam, chr=chr,
+            metrics_runner.add_task(picard_metrics_worker,
+                    memory=job_memory or 0, in_bam=bam, chr=chr,
                     tracker=metrics_tracker, annot=annot, jar=jar,
-                    samtools_exe=samtools_exe, java_exe=java_exe)
-    metrics_pool.wait_completion()
+                    samtools_exe=samtools_exe, java_exe=java_exe,
+                    job_memory=job_memory)
+    metrics_runner.wait_completion()
     # checks whether all required stat files are present
     metrics_tracker.check_files()
     return aggregate_metrics(metrics_tracker, chrs)
@@ -470,6 +614,12 @@ if __name__ == '__main__':
     parser.add_argument('--html', dest='is_html',
             action='store_true',
             help='Output HTML file')
+    parser.add_argument('--memory', dest='memory', type=int,
+            help='Maximum total JVM memory (MB) of the Picard jobs running '
+            'at the same time (default: no limit)')
+    parser.add_argument('--job-memory', dest='job_memory', type=int,
+            help='JVM maximum heap size (MB) of each Picard job (default: '
+            'JVM default)')
     parser.add_argument('--jar', dest='jar', type=str,
             help='Path to Picard\'s CollectRnaSeqMetrics.jar')
     parser.add_argument('--java', dest='java', type=str,
@@ -478,9 +628,21 @@ if __name__ == '__main__':
     parser.add_argument('--samtools', dest='samtools', type=str,
             default=EXE_SAMTOOLS,
             help='Path to samtools executable')
+    parser.add_argument('--exclude-flags', dest='exclude_flags',
+            type=lambda x: int(x, 0), default=EXCLUDE_FLAGS,
+            help='Do not count records with any of these SAM flags set per '
+            'chromosome (default: 0x4, unmapped). Other values than 0x4 '
+            'need a pass over the BAM file instead of its index')
 
     args = parser.parse_args()
 
+    if args.threads < 1:
+        parser.error("Number of threads must be at least 1")
+    if args.memory is not None and args.job_memory is None:
+        parser.error("--memory requires --job-memory")
+    if args.memory is not None and args.job_memory > args.memory:
+        parser.error("--job-memory must not exceed --memory")
+
     if args.s_bam is not None and args.as_bam is not None:
         is_strand_spec = True
         in_bams = {'mix': args.m_bam, 'fwd': args.s_bam, 'rev': args.as_bam}
@@ -494,17 +656,18 @@ if __name__ == '__main__':
     chrs = [line.strip() for line in open(args.chrs, 'r')] + ['ALL']
     # check for paths and indices
     bam_files = prep_bam_file(in_bams, is_strand_spec, args.samtools)
-    # use picard and samtools if it's strand-specific
+    # use picard and read counts if it's strand-specific
     if is_strand_spec:
         aggr_data = picard_reads_per_region_count(bam_files, chrs, args.annot,
-                args.jar, args.samtools, args.java)
-        sam_data = samtools_reads_per_region_count(bam_files, chrs,
-                args.samtools)
+                args.jar, args.samtools, args.java, args.threads, args.memory,
+                args.job_memory)
+        sam_data = reads_per_region_count(bam_files, chrs,
+                args.exclude_flags)
         aggr_data['mix'] = sam_data['mix']
-    # otherwise use samtools only
+    # otherwise use read counts only
     else:
-        aggr_data = samtools_reads_per_region_count(bam_files, chrs,
-                args.samtools)
+        aggr_data = reads_per_region_count(bam_files, chrs,
+                args.exclude_flags)
 
     # write to output file
     if args.out_file is None: